@@ -0,0 +1,229 @@
+"""
+Shared helpers for the Azure SQL Database comparison scripts.
+
+Used by compare-databases.py and compare-databases-filtered.py, which
+import it as a sibling module from the script directory.
+validate-database-integrity.py imports its connection helpers the same way.
+
+Requirements:
+    pip install pyodbc azure-identity
+"""
+
+import atexit
+import sys
+import struct
+import time
+import pyodbc
+from azure.identity import AzureCliCredential
+from concurrent.futures import ThreadPoolExecutor
+
+# ANSI color codes
+class Colors:
+    RED = '\033[0;31m'
+    GREEN = '\033[0;32m'
+    YELLOW = '\033[1;33m'
+    CYAN = '\033[0;36m'
+    GRAY = '\033[0;37m'
+    BOLD = '\033[1m'
+    NC = '\033[0m'
+
+def print_header(message):
+    print(f"{Colors.CYAN}{Colors.BOLD}{message}{Colors.NC}")
+
+def print_success(message):
+    print(f"{Colors.GREEN}{message}{Colors.NC}")
+
+def fmt_error(message):
+    return f"{Colors.RED}{message}{Colors.NC}"
+
+def fmt_warning(message):
+    return f"{Colors.YELLOW}{message}{Colors.NC}"
+
+def print_error(message):
+    print(fmt_error(message))
+
+def print_warning(message):
+    print(fmt_warning(message))
+
+def print_info(message):
+    print(f"{Colors.GRAY}{message}{Colors.NC}")
+
+def write_lines(lines):
+    """Write already formatted lines to stdout in a single call."""
+    sys.stdout.write("\n".join(lines) + "\n")
+
+# Azure CLI credential and SQL token, shared by every connection in the process
+_credential = None
+_sql_token = None
+
+# Refresh the cached token this many seconds before it expires
+TOKEN_REFRESH_MARGIN = 60
+
+def get_azure_sql_token():
+    """Get Azure AD access token for SQL Database.
+    
+    The token is cached and reused until shortly before it expires, so
+    opening several connections only runs 'az' once.
+    """
+    global _credential, _sql_token
+    try:
+        if _sql_token is None or time.time() >= _sql_token.expires_on - TOKEN_REFRESH_MARGIN:
+            if _credential is None:
+                _credential = AzureCliCredential()
+            _sql_token = _credential.get_token("https://database.windows.net/.default")
+        return _sql_token.token
+    except Exception as e:
+        print_error(f"Failed to get Azure AD token: {e}")
+        return None
+
+# Length prefix of the SQL_COPT_SS_ACCESS_TOKEN structure
+TOKEN_LENGTH_PREFIX = struct.Struct('<I')
+
+# Last token packed for the ODBC driver, as (token, packed bytes)
+_token_struct = None
+
+CONNECTION_STRING_TEMPLATE = (
+    "DRIVER={{ODBC Driver 18 for SQL Server}};"
+    "SERVER={server};"
+    "DATABASE={database};"
+    "Encrypt=yes;"
+    "TrustServerCertificate=no;"
+)
+
+def get_token_struct(token):
+    """Pack an access token for SQL_COPT_SS_ACCESS_TOKEN, reusing the last result."""
+    global _token_struct
+    if _token_struct is None or _token_struct[0] != token:
+        token_bytes = token.encode('utf-16-le')
+        _token_struct = (token, TOKEN_LENGTH_PREFIX.pack(len(token_bytes)) + token_bytes)
+    return _token_struct[1]
+
+# Open connections keyed by (server, database), reused for the process lifetime
+_connections = {}
+
+def create_connection(server, database):
+    """Create a connection to Azure SQL Database using Azure AD token.
+    
+    Connections are cached per (server, database), so repeated comparisons
+    in one process skip the TLS handshake and login.
+    """
+    conn = _connections.get((server, database))
+    if conn is not None and not conn.closed:
+        return conn
+    
+    conn = open_connection(server, database)
+    if conn is not None:
+        _connections[(server, database)] = conn
+    return conn
+
+def open_connection(server, database):
+    """Open a new, uncached connection to Azure SQL Database."""
+    try:
+        token = get_azure_sql_token()
+        if not token:
+            return None
+        
+        token_struct = get_token_struct(token)
+        connection_string = CONNECTION_STRING_TEMPLATE.format(server=server, database=database)
+        
+        return pyodbc.connect(connection_string, attrs_before={1256: token_struct})
+    except Exception as e:
+        print_error(f"Failed to connect to {database}: {e}")
+        return None
+
+def close_connections(connections):
+    """Close and forget every connection in a connection cache."""
+    for conn in connections.values():
+        try:
+            conn.close()
+        except pyodbc.Error:
+            pass
+    connections.clear()
+
+def close_all_connections():
+    """Close every cached connection."""
+    close_connections(_connections)
+
+atexit.register(close_all_connections)
+
+def sql_placeholders(values):
+    """Build a '?, ?, ...' parameter list for a SQL IN clause."""
+    return ", ".join("?" * len(values))
+
+def exclusion_clause(column, excluded):
+    """Build an 'AND column NOT IN (...)' filter, or nothing when excluded is empty."""
+    if not excluded:
+        return ""
+    return f"AND {column} NOT IN ({sql_placeholders(excluded)})"
+
+def quote_name(name):
+    """Quote an identifier for SQL Server, like QUOTENAME()."""
+    return "[" + name.replace("]", "]]") + "]"
+
+def get_tables(cursor, excluded=frozenset()):
+    """Get set of tables, skipping any whose name is in excluded."""
+    cursor.execute(f"""
+        SELECT TABLE_SCHEMA, TABLE_NAME
+        FROM INFORMATION_SCHEMA.TABLES
+        WHERE TABLE_TYPE = 'BASE TABLE'
+          {exclusion_clause('TABLE_NAME', excluded)}
+    """, *excluded)
+    return frozenset((row[0], row[1]) for row in cursor)
+
+def get_views(cursor, excluded=frozenset()):
+    """Get set of views, skipping any whose name is in excluded."""
+    cursor.execute(f"""
+        SELECT TABLE_SCHEMA, TABLE_NAME
+        FROM INFORMATION_SCHEMA.VIEWS
+        WHERE 1 = 1
+          {exclusion_clause('TABLE_NAME', excluded)}
+    """, *excluded)
+    return frozenset((row[0], row[1]) for row in cursor)
+
+def get_procedures(cursor, excluded=frozenset()):
+    """Get set of stored procedures, skipping any whose name is in excluded."""
+    cursor.execute(f"""
+        SELECT ROUTINE_SCHEMA, ROUTINE_NAME
+        FROM INFORMATION_SCHEMA.ROUTINES
+        WHERE ROUTINE_TYPE = 'PROCEDURE'
+          {exclusion_clause('ROUTINE_NAME', excluded)}
+    """, *excluded)
+    return frozenset((row[0], row[1]) for row in cursor)
+
+def get_functions(cursor, excluded=frozenset()):
+    """Get set of functions, skipping any whose name is in excluded."""
+    cursor.execute(f"""
+        SELECT ROUTINE_SCHEMA, ROUTINE_NAME
+        FROM INFORMATION_SCHEMA.ROUTINES
+        WHERE ROUTINE_TYPE = 'FUNCTION'
+          {exclusion_clause('ROUTINE_NAME', excluded)}
+    """, *excluded)
+    return frozenset((row[0], row[1]) for row in cursor)
+
+def fetch_in_parallel(fetch, source_cursor, target_cursor, *args):
+    """Run the same catalog query against source and target concurrently.
+    
+    Each cursor belongs to its own connection, so the two round-trips can
+    safely overlap; pyodbc releases the GIL while waiting on the server.
+    Comparing a database with itself shares one connection, which must not
+    be used from two threads, so that case runs sequentially.
+    """
+    if source_cursor.connection is target_cursor.connection:
+        return fetch(source_cursor, *args), fetch(target_cursor, *args)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        source_future = executor.submit(fetch, source_cursor, *args)
+        target_result = fetch(target_cursor, *args)
+        return source_future.result(), target_result
+
+def compare_lists(source_set, target_set, item_name):
+    """Compare two sets and return differences."""
+    # Nothing to hash or probe when either side is empty
+    if not source_set:
+        return frozenset(), target_set
+    if not target_set:
+        return source_set, frozenset()
+    
+    missing_in_target = source_set - target_set
+    extra_in_target = target_set - source_set
+    
+    return missing_in_target, extra_in_target
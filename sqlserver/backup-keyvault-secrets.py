@@ -2,11 +2,12 @@
 """
 Azure Key Vault Backup Script with SOPS Encryption
 
-Backs up Azure Key Vault secrets to JSON, encrypts with SOPS,
+Backs up Azure Key Vault secrets to gzip-compressed JSON, encrypts with SOPS,
 and uploads to Azure Blob Storage.
 
 Requirements:
-    pip install azure-identity azure-keyvault-secrets azure-storage-blob
+    Python 3.10+
+    pip install azure-identity azure-keyvault-secrets azure-storage-blob aiohttp requests
     
     SOPS must be installed:
     - macOS: brew install sops
@@ -19,6 +20,12 @@ Requirements:
     Or GPG/PGP:
     - macOS: brew install gnupg
     - Linux: https://gnupg.org/download/
+    
+    Optional, for faster JSON serialization of large vaults:
+    pip install orjson
+    
+    Optional, for --in-process Age encryption without SOPS:
+    pip install pyrage
 
 Usage:
     # First time: Generate Age key
@@ -34,43 +41,105 @@ Usage:
 """
 
 import argparse
+import asyncio
+import atexit
+import gzip
+import hashlib
+import io
 import json
+import mmap
 import os
 import sys
 import subprocess
 import tempfile
+import threading
+import time
+from dataclasses import dataclass, fields
 from datetime import datetime
 from pathlib import Path
 
 from azure.identity import DefaultAzureCredential, AzureCliCredential
-from azure.keyvault.secrets import SecretClient
-from azure.storage.blob import BlobServiceClient, BlobClient
+from azure.keyvault.secrets.aio import SecretClient as AsyncSecretClient
+from azure.storage.blob import BlobServiceClient, BlobClient, ContentSettings
 from azure.core.exceptions import ResourceNotFoundError
+from azure.core.pipeline.transport import AioHttpTransport, RequestsTransport
+import aiohttp
+import requests
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import pyrage
+except ImportError:
+    pyrage = None
+
+# Concurrent Key Vault requests when retrieving secret values
+MAX_SECRET_WORKERS = 16
+
+# Pooled connections per host; must cover MAX_SECRET_WORKERS or the
+# concurrent requests end up opening and discarding sockets
+HTTP_POOL_MAXSIZE = 32
+
+# Parallel block uploads for the encrypted backup blob; anything larger than
+# the single-put size is split into blocks that are uploaded concurrently
+BLOB_UPLOAD_CONCURRENCY = 8
+BLOB_MAX_BLOCK_SIZE = 4 * 1024 * 1024
+BLOB_MAX_SINGLE_PUT_SIZE = 8 * 1024 * 1024
+
+KEY_VAULT_SCOPE = "https://vault.azure.net/.default"
+
+# gzip level for the backup before encryption; the JSON is highly redundant
+BACKUP_COMPRESSLEVEL = 6
+
+# Refresh cached access tokens this many seconds before they expire
+TOKEN_REFRESH_MARGIN = 300
+
+# Let the SDK retry policy absorb Key Vault throttling (429) and transient
+# failures during the fan-out, rather than dropping secrets from the backup
+SECRET_CLIENT_OPTIONS = {
+    'retry_mode': 'exponential',
+    'retry_total': 10,
+    'retry_backoff_factor': 0.8,
+    'retry_backoff_max': 30,
+}
+
+# ANSI color codes (disabled when stdout is not a terminal)
+_USE_COLOR = sys.stdout.isatty()
 
-# ANSI color codes
 class Colors:
-    RED = '\033[0;31m'
-    GREEN = '\033[0;32m'
-    YELLOW = '\033[1;33m'
-    CYAN = '\033[0;36m'
-    GRAY = '\033[0;37m'
-    BOLD = '\033[1m'
-    NC = '\033[0m'
+    RED = '\033[0;31m' if _USE_COLOR else ''
+    GREEN = '\033[0;32m' if _USE_COLOR else ''
+    YELLOW = '\033[1;33m' if _USE_COLOR else ''
+    CYAN = '\033[0;36m' if _USE_COLOR else ''
+    GRAY = '\033[0;37m' if _USE_COLOR else ''
+    BOLD = '\033[1m' if _USE_COLOR else ''
+    NC = '\033[0m' if _USE_COLOR else ''
+
+# Colored line formats, fixed once _USE_COLOR is known
+_write = sys.stdout.write
+_HEADER_TEMPLATE = f"{Colors.CYAN}{Colors.BOLD}%s{Colors.NC}\n"
+_SUCCESS_TEMPLATE = f"{Colors.GREEN}%s{Colors.NC}\n"
+_ERROR_TEMPLATE = f"{Colors.RED}%s{Colors.NC}\n"
+_WARNING_TEMPLATE = f"{Colors.YELLOW}%s{Colors.NC}\n"
+_INFO_TEMPLATE = f"{Colors.GRAY}%s{Colors.NC}\n"
 
 def print_header(message):
-    print(f"{Colors.CYAN}{Colors.BOLD}{message}{Colors.NC}")
+    _write(_HEADER_TEMPLATE % (message,))
 
 def print_success(message):
-    print(f"{Colors.GREEN}{message}{Colors.NC}")
+    _write(_SUCCESS_TEMPLATE % (message,))
 
 def print_error(message):
-    print(f"{Colors.RED}{message}{Colors.NC}")
+    _write(_ERROR_TEMPLATE % (message,))
 
 def print_warning(message):
-    print(f"{Colors.YELLOW}{message}{Colors.NC}")
+    _write(_WARNING_TEMPLATE % (message,))
 
 def print_info(message):
-    print(f"{Colors.GRAY}{message}{Colors.NC}")
+    _write(_INFO_TEMPLATE % (message,))
 
 def check_sops_installed():
     """Check if SOPS is installed and available."""
@@ -86,91 +155,267 @@ def check_sops_installed():
     except FileNotFoundError:
         return False, None
 
-def get_azure_credential():
-    """Get Azure credential, preferring Azure CLI."""
-    try:
-        # Try Azure CLI credential first (most common for scripts)
-        credential = AzureCliCredential()
-        # Test the credential
-        credential.get_token("https://vault.azure.net/.default")
-        return credential
-    except Exception:
-        # Fall back to DefaultAzureCredential (includes managed identity, etc.)
+# BlobServiceClient per storage account and (account, container) pairs known
+# to exist, reused across backups run from the same process
+_blob_service_clients = {}
+_known_containers = set()
+
+def create_http_session():
+    """Create an HTTP session with an enlarged connection pool for the Storage clients."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=HTTP_POOL_MAXSIZE)
+    session.mount('https://', adapter)
+    return session
+
+def create_transport(session):
+    """Wrap an HTTP session in an Azure SDK transport that closes it with the client."""
+    return RequestsTransport(session=session, session_owner=True)
+
+class CachedTokenCredential:
+    """Wraps a credential and reuses its tokens until shortly before expiry.
+
+    AzureCliCredential runs an 'az' subprocess for every get_token call, so
+    the token acquired when probing the credential is reused by the Key
+    Vault and Storage clients instead of spawning 'az' again. Tokens are
+    cached per scope; the vault and storage account are assumed to be in
+    the signed-in tenant.
+    """
+
+    def __init__(self, credential):
+        self._credential = credential
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def get_token(self, *scopes, claims=None, **kwargs):
+        if claims:
+            # A claims challenge needs a fresh token
+            return self._credential.get_token(*scopes, claims=claims, **kwargs)
+        with self._lock:
+            token = self._tokens.get(scopes)
+            if token is None or token.expires_on - TOKEN_REFRESH_MARGIN <= time.time():
+                token = self._credential.get_token(*scopes, **kwargs)
+                self._tokens[scopes] = token
+            return token
+
+class AsyncCachedTokenCredential:
+    """Exposes a CachedTokenCredential to the asyncio SDK clients.
+
+    Cached tokens are returned without blocking; a refresh runs the
+    wrapped synchronous credential inline, which only happens on expiry.
+    """
+
+    def __init__(self, credential):
+        self._credential = credential
+
+    async def get_token(self, *scopes, **kwargs):
+        return self._credential.get_token(*scopes, **kwargs)
+
+    async def close(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+def get_azure_credential(use_default_credential=False):
+    """Get Azure credential, preferring Azure CLI.
+
+    With use_default_credential, the Azure CLI is skipped and only
+    DefaultAzureCredential is tried (e.g. on managed-identity hosts, where
+    this avoids spawning 'az' at all).
+    """
+    if not use_default_credential:
         try:
-            credential = DefaultAzureCredential()
-            credential.get_token("https://vault.azure.net/.default")
+            # Try Azure CLI credential first (most common for scripts)
+            credential = CachedTokenCredential(AzureCliCredential())
+            # Test the credential; the token is cached for the clients
+            credential.get_token(KEY_VAULT_SCOPE)
             return credential
-        except Exception as e:
-            print_error(f"Failed to acquire Azure credentials: {e}")
-            print_info("Please ensure you're logged in: az login")
-            return None
-
-def list_keyvault_secrets(vault_url, credential):
-    """List all secrets in the Key Vault."""
+        except Exception:
+            pass
+    
+    # Fall back to DefaultAzureCredential (includes managed identity, etc.)
     try:
-        client = SecretClient(vault_url=vault_url, credential=credential)
-        secrets = []
-        
-        print_info("      Listing secrets...")
-        for secret_properties in client.list_properties_of_secrets():
-            if secret_properties.enabled:
-                secrets.append({
-                    'name': secret_properties.name,
-                    'enabled': secret_properties.enabled,
-                    'created': secret_properties.created_on.isoformat() if secret_properties.created_on else None,
-                    'updated': secret_properties.updated_on.isoformat() if secret_properties.updated_on else None,
-                    'content_type': secret_properties.content_type,
-                    'tags': secret_properties.tags
-                })
-        
-        return secrets
+        credential = CachedTokenCredential(DefaultAzureCredential())
+        credential.get_token(KEY_VAULT_SCOPE)
+        return credential
     except Exception as e:
-        print_error(f"Failed to list secrets: {e}")
+        print_error(f"Failed to acquire Azure credentials: {e}")
+        print_info("Please ensure you're logged in: az login")
         return None
 
-def get_secret_values(vault_url, credential, secret_names):
-    """Get values for all secrets."""
-    client = SecretClient(vault_url=vault_url, credential=credential)
-    secrets_with_values = []
+@dataclass(slots=True)
+class SecretRecord:
+    """A secret value with the properties preserved in the backup."""
+    name: str
+    value: str
+    enabled: bool
+    created: datetime | None
+    updated: datetime | None
+    content_type: str | None
+    tags: dict | None
+
+async def get_secret_values(vault_url, credential, backup_writer):
+    """List enabled secrets and retrieve their values in a single pass.
+
+    Runs on the asyncio Key Vault client: each enabled secret from the
+    properties listing becomes a task as soon as its page arrives, so value
+    retrieval overlaps with pagination, and all requests are multiplexed
+    over one SecretClient and connection pool. A semaphore of
+    MAX_SECRET_WORKERS keeps us well under the vault's service throttling
+    limits.
+
+    Each secret is handed to backup_writer as soon as it arrives, in
+    completion order. Transient failures are retried by the SDK retry
+    policy; any error that remains fails the whole retrieval rather than
+    producing an incomplete backup. Returns the number of secrets
+    written, or None if retrieval failed.
+    """
+    semaphore = asyncio.Semaphore(MAX_SECRET_WORKERS)
+    retrieved = 0
     
-    print_info(f"      Retrieving {len(secret_names)} secret values...")
+    print_info("      Listing and retrieving secrets...")
     
-    for i, secret_info in enumerate(secret_names, 1):
-        secret_name = secret_info['name']
+    async def fetch(client, secret_properties):
+        nonlocal retrieved
+        secret_name = secret_properties.name
         try:
-            secret = client.get_secret(secret_name)
-            secrets_with_values.append({
-                'name': secret.name,
-                'value': secret.value,
-                'enabled': secret_info['enabled'],
-                'created': secret_info['created'],
-                'updated': secret_info['updated'],
-                'content_type': secret_info['content_type'],
-                'tags': secret_info['tags']
-            })
+            async with semaphore:
+                secret = await client.get_secret(secret_name)
+        except ResourceNotFoundError:
+            # Deleted between listing and retrieval
+            print_warning(f"        Warning: Secret '{secret_name}' no longer exists, skipping")
+            return
+        
+        retrieved += 1
+        if retrieved % 10 == 0:
+            print_info(f"        Retrieved {retrieved} secrets...")
+        
+        backup_writer.write_secret(SecretRecord(
+            name=secret.name,
+            value=secret.value,
+            enabled=secret_properties.enabled,
+            created=secret_properties.created_on,
+            updated=secret_properties.updated_on,
+            content_type=secret_properties.content_type,
+            tags=secret_properties.tags
+        ))
+    
+    connector = aiohttp.TCPConnector(limit=HTTP_POOL_MAXSIZE)
+    try:
+        async with AsyncCachedTokenCredential(credential) as async_credential, \
+                aiohttp.ClientSession(connector=connector) as http_session:
+            # Make sure a valid token is cached before the fan-out so the
+            # tasks don't each run their own authentication round-trip
+            await async_credential.get_token(KEY_VAULT_SCOPE)
             
-            if i % 10 == 0:
-                print_info(f"        Retrieved {i}/{len(secret_names)} secrets...")
-        except Exception as e:
-            print_warning(f"        Warning: Could not retrieve secret '{secret_name}': {e}")
+            transport = AioHttpTransport(session=http_session, session_owner=False)
+            async with AsyncSecretClient(vault_url=vault_url, credential=async_credential,
+                                         transport=transport, **SECRET_CLIENT_OPTIONS) as client:
+                tasks = []
+                try:
+                    # Walk the listing page by page, starting fetches for a
+                    # page's enabled secrets before the next page is requested;
+                    # disabled secrets are dropped without any further work
+                    async for page in client.list_properties_of_secrets().by_page():
+                        tasks.extend([
+                            asyncio.create_task(fetch(client, secret_properties))
+                            async for secret_properties in page
+                            if secret_properties.enabled
+                        ])
+                    await asyncio.gather(*tasks)
+                except Exception:
+                    # A secret that still fails after retries would leave the
+                    # backup incomplete, so abort the whole run
+                    for task in tasks:
+                        task.cancel()
+                    # Let the cancelled tasks finish before the client and
+                    # session they use are closed
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                    raise
+    except Exception as e:
+        print_error(f"Failed to retrieve secrets: {e}")
+        return None
     
-    return secrets_with_values
-
-def create_backup_json(secrets, vault_name):
-    """Create backup JSON structure."""
-    backup_data = {
-        'backup_metadata': {
-            'vault_name': vault_name,
-            'backup_timestamp': datetime.utcnow().isoformat() + 'Z',
-            'secret_count': len(secrets),
-            'backup_version': '1.0'
-        },
-        'secrets': secrets
+    return retrieved
+
+def create_backup_metadata(vault_name, secret_count):
+    """Create the backup metadata block."""
+    return {
+        'vault_name': vault_name,
+        'backup_timestamp': datetime.utcnow().isoformat() + 'Z',
+        'secret_count': secret_count,
+        'backup_version': '1.0'
     }
-    return backup_data
 
-def encrypt_with_sops(json_file_path, sops_config):
-    """Encrypt JSON file using SOPS."""
+def _json_default(value):
+    """Serialize datetimes and SecretRecords the same way orjson does."""
+    if isinstance(value, datetime):
+        return value.isoformat().replace('+00:00', 'Z')
+    if isinstance(value, SecretRecord):
+        return {field.name: getattr(value, field.name) for field in fields(value)}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def dump_json(value):
+    """Serialize a value to JSON bytes, using orjson when available."""
+    if orjson is not None:
+        return orjson.dumps(value, option=orjson.OPT_UTC_Z)
+    return json.dumps(value, default=_json_default).encode('utf-8')
+
+class BackupJsonWriter:
+    """Writes the backup JSON incrementally to a binary stream.
+
+    Secrets are serialized one record per line as they are retrieved, so
+    the full set of secret dicts is never held in memory alongside the
+    serialized output. The metadata block is written last, once the
+    secret count is known.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.secret_count = 0
+        self.stream.write(b'{"secrets": [\n')
+
+    def write_secret(self, secret):
+        if self.secret_count:
+            self.stream.write(b',\n')
+        self.stream.write(dump_json(secret))
+        self.secret_count += 1
+
+    def finish(self, vault_name):
+        self.stream.write(b'\n], "backup_metadata": ')
+        self.stream.write(dump_json(create_backup_metadata(vault_name, self.secret_count)))
+        self.stream.write(b'}\n')
+
+def get_encrypted_backup_name(backup_name, compressed, in_process):
+    """Derive the blob name from the backup name and the output format."""
+    if in_process:
+        suffix = '.json.gz.age' if compressed else '.json.age'
+    else:
+        suffix = '.json.gz.enc' if compressed else '.enc.json'
+    if backup_name.endswith(suffix):
+        return backup_name
+    if backup_name.endswith('.json'):
+        backup_name = backup_name[:-len('.json')]
+    return backup_name + suffix
+
+def encrypt_with_sops(backup_bytes, sops_config, compressed=False):
+    """Encrypt the backup using SOPS.
+
+    The plaintext is piped to SOPS on stdin, so it never touches disk.
+    Compressed (gzip) backups are encrypted as a SOPS binary document.
+
+    Multiple recipients are passed to a single SOPS run as a comma-separated
+    list; SOPS generates one data key and wraps it for every recipient.
+
+    The encrypted output is written straight to a temporary file rather
+    than captured in memory, so it can be streamed to Blob Storage.
+    Returns the path of that file; the caller is responsible for removing it.
+    """
+    encrypted_path = None
+    plaintext_path = None
     try:
         # Build SOPS command
         cmd = ['sops', '--encrypt']
@@ -184,46 +429,114 @@ def encrypt_with_sops(json_file_path, sops_config):
             print_error("No SOPS encryption method specified")
             return None
         
-        # Input file
-        cmd.append(str(json_file_path))
+        # Read plaintext from stdin; the format can't be inferred from a file name.
+        # Windows has no /dev/stdin, so there it goes through a temporary file
+        input_type = 'binary' if compressed else 'json'
+        if os.name == 'nt':
+            with tempfile.NamedTemporaryFile(suffix='.plain', delete=False) as plaintext_file:
+                plaintext_path = plaintext_file.name
+                plaintext_file.write(backup_bytes)
+            input_path, input_bytes = plaintext_path, None
+        else:
+            input_path, input_bytes = '/dev/stdin', backup_bytes
+        cmd.extend(['--input-type', input_type, '--output-type', 'json', input_path])
         
         # Run SOPS encryption
         print_info("      Running SOPS encryption...")
-        result = subprocess.run(cmd, 
-                              capture_output=True, 
-                              text=True, 
-                              check=False)
+        with tempfile.NamedTemporaryFile(suffix='.enc.json', delete=False) as encrypted_file:
+            encrypted_path = encrypted_file.name
+            result = subprocess.run(cmd, 
+                                  input=input_bytes, 
+                                  stdout=encrypted_file, 
+                                  stderr=subprocess.PIPE, 
+                                  check=False)
         
         if result.returncode != 0:
-            print_error(f"SOPS encryption failed: {result.stderr}")
+            print_error(f"SOPS encryption failed: {result.stderr.decode(errors='replace')}")
+            os.remove(encrypted_path)
             return None
         
-        return result.stdout  # Encrypted content
+        return encrypted_path
         
     except Exception as e:
         print_error(f"Failed to encrypt with SOPS: {e}")
+        if encrypted_path and os.path.exists(encrypted_path):
+            os.remove(encrypted_path)
         return None
+    finally:
+        if plaintext_path and os.path.exists(plaintext_path):
+            os.remove(plaintext_path)
 
-def upload_to_blob_storage(storage_account, container, blob_name, content, credential):
-    """Upload encrypted backup to Azure Blob Storage."""
+def encrypt_with_age(backup_bytes, age_recipients):
+    """Encrypt the backup in-process with Age (pyrage), without spawning SOPS."""
     try:
-        # Create blob service client
+        print_info("      Running in-process Age encryption...")
+        recipients = [pyrage.x25519.Recipient.from_str(key.strip())
+                      for key in age_recipients.split(',')]
+        return pyrage.encrypt(backup_bytes, recipients)
+    except Exception as e:
+        print_error(f"Failed to encrypt with Age: {e}")
+        return None
+
+def get_blob_service_client(storage_account, credential):
+    """Get the BlobServiceClient for a storage account, creating it once per process.
+
+    Each client gets its own pooled HTTP session, created alongside it and
+    closed with it, so reused clients don't leave unused sessions behind.
+    """
+    blob_service_client = _blob_service_clients.get(storage_account)
+    if blob_service_client is None:
         blob_service_client = BlobServiceClient(
             account_url=f"https://{storage_account}.blob.core.windows.net",
-            credential=credential
+            credential=credential,
+            transport=create_transport(create_http_session()),
+            max_block_size=BLOB_MAX_BLOCK_SIZE,
+            max_single_put_size=BLOB_MAX_SINGLE_PUT_SIZE
         )
-        
-        # Get container client
-        container_client = blob_service_client.get_container_client(container)
-        
-        # Create container if it doesn't exist
-        try:
-            container_client.get_container_properties()
-            print_info(f"      Container '{container}' exists")
-        except ResourceNotFoundError:
-            print_info(f"      Creating container '{container}'...")
-            container_client.create_container()
-            print_success(f"      Container created")
+        _blob_service_clients[storage_account] = blob_service_client
+    return blob_service_client
+
+def close_blob_service_clients():
+    """Close every cached BlobServiceClient and its HTTP session."""
+    for blob_service_client in _blob_service_clients.values():
+        blob_service_client.close()
+    _blob_service_clients.clear()
+    _known_containers.clear()
+
+atexit.register(close_blob_service_clients)
+
+def compute_backup_digests(data):
+    """Compute the MD5 and SHA-256 digests of the encrypted backup.
+
+    data is any bytes-like object, e.g. an mmap of the SOPS output, so the
+    file is hashed without being read into memory. hashlib runs OpenSSL's
+    hardware-accelerated implementations and releases the GIL.
+    """
+    content_md5 = hashlib.md5(data, usedforsecurity=False).digest()
+    sha256 = hashlib.sha256(data).hexdigest()
+    return content_md5, sha256
+
+def upload_to_blob_storage(blob_service_client, container, blob_name, data, length,
+                           content_md5, sha256):
+    """Upload encrypted backup to Azure Blob Storage.
+
+    data is a binary stream of length bytes, which the SDK reads and
+    uploads in blocks. The MD5 is stored as the blob's Content-MD5 and the
+    SHA-256 as 'sha256' metadata, so downloads can be verified end to end.
+    """
+    try:
+        # Create container if it doesn't exist (checked once per process)
+        container_key = (blob_service_client.account_name, container)
+        if container_key not in _known_containers:
+            container_client = blob_service_client.get_container_client(container)
+            try:
+                container_client.get_container_properties()
+                print_info(f"      Container '{container}' exists")
+            except ResourceNotFoundError:
+                print_info(f"      Creating container '{container}'...")
+                container_client.create_container()
+                print_success(f"      Container created")
+            _known_containers.add(container_key)
         
         # Upload blob
         print_info(f"      Uploading to blob: {blob_name}")
@@ -232,7 +545,15 @@ def upload_to_blob_storage(storage_account, container, blob_name, content, crede
             blob=blob_name
         )
         
-        blob_client.upload_blob(content, overwrite=True)
+        blob_client.upload_blob(
+            data,
+            blob_type="BlockBlob",
+            length=length,
+            content_settings=ContentSettings(content_md5=bytearray(content_md5)),
+            metadata={'sha256': sha256},
+            overwrite=True,
+            max_concurrency=BLOB_UPLOAD_CONCURRENCY
+        )
         
         blob_url = blob_client.url
         return blob_url
@@ -241,8 +562,16 @@ def upload_to_blob_storage(storage_account, container, blob_name, content, crede
         print_error(f"Failed to upload to blob storage: {e}")
         return None
 
-def backup_keyvault(vault_name, storage_account, container, sops_config, backup_name=None):
-    """Main backup function."""
+def backup_keyvault(vault_name, storage_account, container, sops_config, backup_name=None,
+                    in_process=False, use_default_credential=False, compress=True):
+    """Main backup function.
+
+    With compress, the backup JSON is gzipped as it is written, before
+    encryption, which shrinks both the upload and the stored blob.
+
+    With in_process, the backup is encrypted directly with Age via pyrage
+    instead of SOPS, producing a plain Age file rather than a SOPS document.
+    """
     
     print()
     print_header("=" * 80)
@@ -262,90 +591,124 @@ def backup_keyvault(vault_name, storage_account, container, sops_config, backup_
     print()
     
     # Check SOPS installation
-    print_header("[1/6] Checking prerequisites...")
-    sops_installed, sops_version = check_sops_installed()
-    if not sops_installed:
-        print_error("  ✗ SOPS is not installed")
-        print_error("")
-        print_error("Install SOPS:")
-        print_error("  macOS: brew install sops")
-        print_error("  Linux: https://github.com/mozilla/sops/releases")
-        print_error("  Windows: https://github.com/mozilla/sops/releases")
-        return False
-    print_success(f"  ✓ SOPS is installed ({sops_version})")
+    print_header("[1/5] Checking prerequisites...")
+    if in_process:
+        if pyrage is None:
+            print_error("  ✗ pyrage is not installed")
+            print_error("")
+            print_error("Install pyrage for --in-process encryption:")
+            print_error("  pip install pyrage")
+            return False
+        print_success("  ✓ pyrage is installed (in-process Age encryption)")
+    else:
+        sops_installed, sops_version = check_sops_installed()
+        if not sops_installed:
+            print_error("  ✗ SOPS is not installed")
+            print_error("")
+            print_error("Install SOPS:")
+            print_error("  macOS: brew install sops")
+            print_error("  Linux: https://github.com/mozilla/sops/releases")
+            print_error("  Windows: https://github.com/mozilla/sops/releases")
+            return False
+        print_success(f"  ✓ SOPS is installed ({sops_version})")
     print()
     
     # Get Azure credentials
-    print_header("[2/6] Authenticating to Azure...")
-    credential = get_azure_credential()
+    print_header("[2/5] Authenticating to Azure...")
+    credential = get_azure_credential(use_default_credential)
     if not credential:
         print_error("  ✗ Failed to authenticate")
         return False
     print_success("  ✓ Authenticated to Azure")
     print()
     
-    # List Key Vault secrets
-    print_header("[3/6] Listing Key Vault secrets...")
-    vault_url = f"https://{vault_name}.vault.azure.net"
-    secrets_list = list_keyvault_secrets(vault_url, credential)
+    blob_service_client = get_blob_service_client(storage_account, credential)
     
-    if not secrets_list:
-        print_error("  ✗ No secrets found or failed to list secrets")
-        return False
-    
-    print_success(f"  ✓ Found {len(secrets_list)} enabled secrets")
-    print()
-    
-    # Get secret values
-    print_header("[4/6] Retrieving secret values...")
-    secrets_with_values = get_secret_values(vault_url, credential, secrets_list)
+    # List and retrieve Key Vault secrets
+    print_header("[3/5] Retrieving Key Vault secrets...")
+    vault_url = f"https://{vault_name}.vault.azure.net"
+    backup_buffer = io.BytesIO()
+    if compress:
+        backup_stream = gzip.GzipFile(fileobj=backup_buffer, mode='wb',
+                                      compresslevel=BACKUP_COMPRESSLEVEL)
+    else:
+        backup_stream = backup_buffer
+    backup_writer = BackupJsonWriter(backup_stream)
+    secret_count = asyncio.run(get_secret_values(vault_url, credential, backup_writer))
     
-    if not secrets_with_values:
-        print_error("  ✗ Failed to retrieve secret values")
+    if not secret_count:
+        print_error("  ✗ No secrets found or failed to retrieve secrets")
         return False
     
-    print_success(f"  ✓ Retrieved {len(secrets_with_values)} secret values")
+    print_success(f"  ✓ Retrieved {secret_count} enabled secrets")
     print()
     
     # Create backup JSON
-    print_header("[5/6] Creating and encrypting backup...")
-    backup_data = create_backup_json(secrets_with_values, vault_name)
-    
-    # Write to temporary file
-    with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False) as temp_file:
-        temp_path = temp_file.name
-        json.dump(backup_data, temp_file, indent=2)
+    print_header("[4/5] Creating and encrypting backup...")
+    backup_writer.finish(vault_name)
+    if compress:
+        # Writes the gzip trailer; the underlying buffer stays open
+        backup_stream.close()
+    backup_bytes = backup_buffer.getvalue()
+    backup_buffer.close()
+    encrypted_backup_name = get_encrypted_backup_name(backup_name, compress, in_process)
+    decompress = " | gunzip" if compress else ""
     
+    encrypted_path = None
     try:
-        # Encrypt with SOPS
-        encrypted_content = encrypt_with_sops(temp_path, sops_config)
-        
-        if not encrypted_content:
-            print_error("  ✗ Encryption failed")
-            return False
-        
-        print_success(f"  ✓ Backup encrypted with SOPS")
-        
-        # Add .enc suffix to backup name if not already present
-        if not backup_name.endswith('.enc.json'):
-            if backup_name.endswith('.json'):
-                encrypted_backup_name = backup_name.replace('.json', '.enc.json')
-            else:
-                encrypted_backup_name = backup_name + '.enc.json'
+        if in_process:
+            # Encrypt straight from memory; no SOPS process or temp file
+            encrypted_content = encrypt_with_age(backup_bytes, sops_config['age'])
+            
+            if not encrypted_content:
+                print_error("  ✗ Encryption failed")
+                return False
+            
+            encryption_method = "Age (in-process)"
+            download_file = "backup" + get_encrypted_backup_name('', compress, in_process)
+            decrypt_command = (f"age --decrypt -i ~/.sops-age-key.txt {download_file}"
+                               f"{decompress} > backup-decrypted.json")
         else:
-            encrypted_backup_name = backup_name
+            # Encrypt with SOPS
+            encrypted_path = encrypt_with_sops(backup_bytes, sops_config, compressed=compress)
+            
+            if not encrypted_path:
+                print_error("  ✗ Encryption failed")
+                return False
+            
+            encryption_method = "SOPS"
+            download_file = "backup" + get_encrypted_backup_name('', compress, in_process)
+            if compress:
+                decrypt_command = (f"sops --decrypt --input-type json --output-type binary "
+                                   f"{download_file}{decompress} > backup-decrypted.json")
+            else:
+                decrypt_command = f"sops --decrypt {download_file} > backup-decrypted.json"
         
+        if compress:
+            print_success(f"  ✓ Backup compressed with gzip ({len(backup_bytes)} bytes)")
+        print_success(f"  ✓ Backup encrypted with {encryption_method}")
         print()
         
-        # Upload to blob storage
-        print_header("[6/6] Uploading to Azure Blob Storage...")
-        blob_url = upload_to_blob_storage(
-            storage_account, 
-            container, 
-            encrypted_backup_name, 
-            encrypted_content, 
-            credential
-        )
+        # Upload to blob storage, streaming the SOPS output from disk
+        print_header("[5/5] Uploading to Azure Blob Storage...")
+        with (open(encrypted_path, 'rb') if encrypted_path else io.BytesIO(encrypted_content)) as data:
+            # Known length lets the SDK plan blocks without probing the stream
+            if encrypted_path:
+                length = os.fstat(data.fileno()).st_size
+                with mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    content_md5, sha256 = compute_backup_digests(mapped)
+            else:
+                length = len(encrypted_content)
+                content_md5, sha256 = compute_backup_digests(encrypted_content)
+            blob_url = upload_to_blob_storage(
+                blob_service_client, 
+                container, 
+                encrypted_backup_name, 
+                data,
+                length,
+                content_md5,
+                sha256
+            )
         
         if not blob_url:
             print_error("  ✗ Upload failed")
@@ -360,13 +723,14 @@ def backup_keyvault(vault_name, storage_account, container, sops_config, backup_
         print_header("=" * 80)
         print()
         print_success(f"✓ Vault: {vault_name}")
-        print_success(f"✓ Secrets backed up: {len(secrets_with_values)}")
-        print_success(f"✓ Encrypted with SOPS: Yes")
+        print_success(f"✓ Secrets backed up: {secret_count}")
+        print_success(f"✓ Encrypted with: {encryption_method}")
         print_success(f"✓ Blob name: {encrypted_backup_name}")
         print_success(f"✓ Container: {container}")
         print_success(f"✓ Storage account: {storage_account}")
         print()
         print_info(f"Blob URL: {blob_url}")
+        print_info(f"SHA-256: {sha256}")
         print()
         
         # Show decryption command
@@ -379,17 +743,31 @@ def backup_keyvault(vault_name, storage_account, container, sops_config, backup_
         print_info(f"    --account-name {storage_account} \\")
         print_info(f"    --container-name {container} \\")
         print_info(f"    --name {encrypted_backup_name} \\")
-        print_info(f"    --file backup.enc.json --auth-mode login")
+        print_info(f"    --file {download_file} --auth-mode login")
+        print_info("")
+        print_info(f"  sha256sum {download_file}  # should match {sha256}")
         print_info("")
-        print_info(f"  sops --decrypt backup.enc.json > backup-decrypted.json")
+        print_info(f"  {decrypt_command}")
         print()
         
         return True
         
     finally:
-        # Clean up temporary file
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
+        # Clean up the encrypted temporary file
+        if encrypted_path and os.path.exists(encrypted_path):
+            os.remove(encrypted_path)
+
+def read_age_public_key(age_file):
+    """Read the public key from an age-keygen key file, or None if it has none.
+
+    The whole file is read at once; splitlines() also handles CRLF files.
+    """
+    data = Path(age_file).read_text(encoding='utf-8-sig')
+    _, found, rest = data.partition('# public key:')
+    if not found:
+        return None
+    lines = rest.splitlines()
+    return lines[0].strip() if lines else None
 
 def main():
     """Main entry point."""
@@ -429,7 +807,24 @@ Examples:
        --container "keyvault-backups" \\
        --pgp "ABC123DEF456789..."
 
-  4. Custom backup name:
+  4. In-process Age encryption (no SOPS binary needed):
+     pip install pyrage
+     python backup-keyvault-secrets.py \\
+       --vault-name "my-keyvault" \\
+       --storage-account "mystorageaccount" \\
+       --container "keyvault-backups" \\
+       --age-file ~/.sops-age-key.txt \\
+       --in-process
+
+  5. Multiple recipients (any one key can decrypt):
+     python backup-keyvault-secrets.py \\
+       --vault-name "my-keyvault" \\
+       --storage-account "mystorageaccount" \\
+       --container "keyvault-backups" \\
+       --age-file ~/.sops-age-key.txt \\
+       --age-file ~/team-age-key.txt
+
+  6. Custom backup name:
      python backup-keyvault-secrets.py \\
        --vault-name "my-keyvault" \\
        --storage-account "mystorageaccount" \\
@@ -439,7 +834,8 @@ Examples:
 
 Prerequisites:
   - Azure CLI: az login
-  - pip install azure-identity azure-keyvault-secrets azure-storage-blob
+    (or --use-default-credential on hosts with a managed identity)
+  - pip install azure-identity azure-keyvault-secrets azure-storage-blob aiohttp requests
   - SOPS: brew install sops (macOS) or https://github.com/mozilla/sops/releases
   - Age (recommended): brew install age OR https://github.com/FiloSottile/age/releases
   - GPG (alternative): brew install gnupg OR https://gnupg.org/download/
@@ -472,37 +868,52 @@ To generate GPG key (one time):
     # SOPS encryption method (one required)
     sops_group = parser.add_mutually_exclusive_group(required=True)
     sops_group.add_argument("--age", 
-                           help="Age public key for SOPS encryption (recommended, simplest)")
+                           help="Age public key(s) for SOPS encryption, comma-separated "
+                                "for multiple recipients (recommended, simplest)")
     sops_group.add_argument("--pgp", 
-                           help="PGP/GPG key fingerprint for SOPS encryption")
-    sops_group.add_argument("--age-file",
-                           help="Path to Age private key file (for auto-loading)")
+                           help="PGP/GPG key fingerprint(s) for SOPS encryption, comma-separated "
+                                "for multiple recipients")
+    sops_group.add_argument("--age-file", action="append",
+                           help="Path to Age private key file (for auto-loading); "
+                                "repeat for multiple recipients")
     
     # Optional arguments
     parser.add_argument("--backup-name", 
                        help="Custom backup file name (default: auto-generated with timestamp)")
+    parser.add_argument("--no-compress", action="store_true",
+                       help="Store the backup as plain JSON instead of gzip-compressing it "
+                            "before encryption")
+    parser.add_argument("--use-default-credential", action="store_true",
+                       help="Authenticate with DefaultAzureCredential only, skipping the Azure CLI "
+                            "(recommended on managed-identity hosts)")
+    parser.add_argument("--in-process", action="store_true",
+                       help="Encrypt with Age in-process via pyrage instead of SOPS "
+                            "(Age only; produces a .age file decrypted with 'age --decrypt')")
     
     args = parser.parse_args()
     
+    if args.in_process and args.pgp:
+        parser.error("--in-process requires an Age key (--age or --age-file)")
+    
     # Build SOPS config
     sops_config = {}
     if args.age:
         sops_config['age'] = args.age
     elif args.age_file:
-        # Read Age public key from file
-        try:
-            with open(args.age_file, 'r') as f:
-                for line in f:
-                    if line.startswith('# public key:'):
-                        sops_config['age'] = line.split(':', 1)[1].strip()
-                        break
-            if 'age' not in sops_config:
-                print_error(f"Could not find public key in {args.age_file}")
+        # Read Age public key from each file
+        recipients = []
+        for age_file in args.age_file:
+            try:
+                public_key = read_age_public_key(age_file)
+            except Exception as e:
+                print_error(f"Failed to read Age key file: {e}")
+                sys.exit(1)
+            if not public_key:
+                print_error(f"Could not find public key in {age_file}")
                 print_info("Expected format: # public key: age1xxx...")
                 sys.exit(1)
-        except Exception as e:
-            print_error(f"Failed to read Age key file: {e}")
-            sys.exit(1)
+            recipients.append(public_key)
+        sops_config['age'] = ','.join(recipients)
     elif args.pgp:
         sops_config['pgp'] = args.pgp
     
@@ -512,7 +923,10 @@ To generate GPG key (one time):
         storage_account=args.storage_account,
         container=args.container,
         sops_config=sops_config,
-        backup_name=args.backup_name
+        backup_name=args.backup_name,
+        in_process=args.in_process,
+        use_default_credential=args.use_default_credential,
+        compress=not args.no_compress
     )
     
     sys.exit(0 if success else 1)
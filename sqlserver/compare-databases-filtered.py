@@ -23,39 +23,19 @@ Usage:
 
 import argparse
 import sys
-import struct
+import threading
 import pyodbc
-from azure.identity import AzureCliCredential
-from collections import defaultdict
-
-# ANSI color codes
-class Colors:
-    RED = '\033[0;31m'
-    GREEN = '\033[0;32m'
-    YELLOW = '\033[1;33m'
-    CYAN = '\033[0;36m'
-    GRAY = '\033[0;37m'
-    BOLD = '\033[1m'
-    NC = '\033[0m'
-
-def print_header(message):
-    print(f"{Colors.CYAN}{Colors.BOLD}{message}{Colors.NC}")
-
-def print_success(message):
-    print(f"{Colors.GREEN}{message}{Colors.NC}")
-
-def print_error(message):
-    print(f"{Colors.RED}{message}{Colors.NC}")
-
-def print_warning(message):
-    print(f"{Colors.YELLOW}{message}{Colors.NC}")
-
-def print_info(message):
-    print(f"{Colors.GRAY}{message}{Colors.NC}")
+from concurrent.futures import ThreadPoolExecutor
+from _compare_common import (
+    create_connection, open_connection, quote_name, fetch_in_parallel, compare_lists,
+    get_tables, get_views, get_procedures, get_functions,
+    print_header, print_success, print_error, print_warning, print_info,
+    fmt_error, fmt_warning, write_lines,
+)
 
 # Objects to exclude (system/diagram-related)
-EXCLUDED_TABLES = {'sysdiagrams'}
-EXCLUDED_PROCEDURES = {
+EXCLUDED_TABLES = frozenset({'sysdiagrams'})
+EXCLUDED_PROCEDURES = frozenset({
     'sp_alterdiagram',
     'sp_creatediagram',
     'sp_dropdiagram',
@@ -63,105 +43,74 @@ EXCLUDED_PROCEDURES = {
     'sp_helpdiagrams',
     'sp_renamediagram',
     'sp_upgraddiagrams'
-}
-EXCLUDED_FUNCTIONS = {'fn_diagramobjects'}
-
-def get_azure_sql_token():
-    """Get Azure AD access token for SQL Database."""
-    try:
-        credential = AzureCliCredential()
-        token = credential.get_token("https://database.windows.net/.default")
-        return token.token
-    except Exception as e:
-        print_error(f"Failed to get Azure AD token: {e}")
-        return None
+})
+EXCLUDED_FUNCTIONS = frozenset({'fn_diagramobjects'})
 
-def create_connection(server, database):
-    """Create a connection to Azure SQL Database using Azure AD token."""
-    try:
-        token = get_azure_sql_token()
-        if not token:
-            return None
-        
-        token_bytes = token.encode('utf-16-le')
-        token_struct = struct.pack(f'<I{len(token_bytes)}s', len(token_bytes), token_bytes)
-        
-        connection_string = (
-            f"DRIVER={{ODBC Driver 18 for SQL Server}};"
-            f"SERVER={server};"
-            f"DATABASE={database};"
-            f"Encrypt=yes;"
-            f"TrustServerCertificate=no;"
-        )
-        
-        conn = pyodbc.connect(connection_string, attrs_before={1256: token_struct})
-        return conn
-    except Exception as e:
-        print_error(f"Failed to connect to {database}: {e}")
-        return None
-
-def get_tables(cursor):
-    """Get list of application tables (excluding system tables)."""
-    cursor.execute("""
-        SELECT TABLE_SCHEMA, TABLE_NAME
-        FROM INFORMATION_SCHEMA.TABLES
-        WHERE TABLE_TYPE = 'BASE TABLE'
-        ORDER BY TABLE_SCHEMA, TABLE_NAME
-    """)
-    return [(row[0], row[1]) for row in cursor.fetchall() if row[1] not in EXCLUDED_TABLES]
-
-def get_views(cursor):
-    """Get list of all views."""
-    cursor.execute("""
-        SELECT TABLE_SCHEMA, TABLE_NAME
-        FROM INFORMATION_SCHEMA.VIEWS
-        ORDER BY TABLE_SCHEMA, TABLE_NAME
-    """)
-    return [(row[0], row[1]) for row in cursor.fetchall()]
-
-def get_procedures(cursor):
-    """Get list of application stored procedures (excluding diagram procedures)."""
+def get_table_row_counts(cursor, tables):
+    """Get row counts for all tables.
+    
+    Counts come from the partition metadata in one query rather than a
+    COUNT(*) scan per table. Tables missing from the result map to None.
+    """
     cursor.execute("""
-        SELECT ROUTINE_SCHEMA, ROUTINE_NAME
-        FROM INFORMATION_SCHEMA.ROUTINES
-        WHERE ROUTINE_TYPE = 'PROCEDURE'
-        ORDER BY ROUTINE_SCHEMA, ROUTINE_NAME
+        SELECT s.name, t.name, SUM(p.rows)
+        FROM sys.partitions p
+        INNER JOIN sys.tables t ON p.object_id = t.object_id
+        INNER JOIN sys.schemas s ON t.schema_id = s.schema_id
+        WHERE p.index_id IN (0, 1)  -- Heap or clustered index only
+        GROUP BY s.name, t.name
     """)
-    return [(row[0], row[1]) for row in cursor.fetchall() if row[1] not in EXCLUDED_PROCEDURES]
+    all_counts = {(row[0], row[1]): row[2] for row in cursor}
+    return {table_key: all_counts.get(table_key) for table_key in tables}
 
-def get_functions(cursor):
-    """Get list of application functions (excluding diagram functions)."""
-    cursor.execute("""
-        SELECT ROUTINE_SCHEMA, ROUTINE_NAME
-        FROM INFORMATION_SCHEMA.ROUTINES
-        WHERE ROUTINE_TYPE = 'FUNCTION'
-        ORDER BY ROUTINE_SCHEMA, ROUTINE_NAME
-    """)
-    return [(row[0], row[1]) for row in cursor.fetchall() if row[1] not in EXCLUDED_FUNCTIONS]
+# Connections per database used for exact row counts
+ROW_COUNT_WORKERS = 8
 
-def get_table_row_counts(cursor, tables):
-    """Get row counts for all tables."""
-    counts = {}
-    for schema, table in tables:
+def get_exact_row_counts(server, database, tables):
+    """Get exact row counts with a COUNT_BIG(*) per table.
+    
+    The scans run on a pool of worker threads, each with its own connection
+    reading at READ UNCOMMITTED so the counts take no shared locks. Tables
+    whose count fails map to None.
+    """
+    local = threading.local()
+    worker_conns = []
+    
+    def open_worker_cursor():
+        conn = open_connection(server, database)
+        if conn is None:
+            local.cursor = None
+            return
         try:
-            cursor.execute(f"SELECT COUNT(*) FROM [{schema}].[{table}]")
-            count = cursor.fetchone()[0]
-            counts[(schema, table)] = count
-        except:
-            counts[(schema, table)] = None
-    return counts
-
-def compare_lists(source_list, target_list, item_name):
-    """Compare two lists and return differences."""
-    source_set = set(source_list)
-    target_set = set(target_list)
+            cursor = conn.cursor()
+            cursor.execute("SET TRANSACTION ISOLATION LEVEL READ UNCOMMITTED")
+        except pyodbc.Error as e:
+            print_warning(f"  ⚠ Failed to prepare a row count connection to {database}: {e}")
+            conn.close()
+            local.cursor = None
+            return
+        worker_conns.append(conn)
+        local.cursor = cursor
     
-    missing_in_target = source_set - target_set
-    extra_in_target = target_set - source_set
+    def count_rows(table_key):
+        if local.cursor is None:
+            return table_key, None
+        schema, table = table_key
+        try:
+            local.cursor.execute(f"SELECT COUNT_BIG(*) FROM {quote_name(schema)}.{quote_name(table)}")
+            return table_key, local.cursor.fetchone()[0]
+        except pyodbc.Error as e:
+            print_warning(f"  ⚠ Failed to count rows in {database}.{schema}.{table}: {e}")
+            return table_key, None
     
-    return missing_in_target, extra_in_target
+    try:
+        with ThreadPoolExecutor(max_workers=ROW_COUNT_WORKERS, initializer=open_worker_cursor) as executor:
+            return dict(executor.map(count_rows, tables))
+    finally:
+        for conn in worker_conns:
+            conn.close()
 
-def compare_databases(server, source_db, target_db):
+def compare_databases(server, source_db, target_db, exact_counts=False):
     """Compare two databases and show differences (application objects only)."""
     
     print()
@@ -190,7 +139,6 @@ def compare_databases(server, source_db, target_db):
     target_conn = create_connection(server, target_db)
     if not target_conn:
         print_error("Failed to connect to target database")
-        source_conn.close()
         return False
     print_success("✓ Connected to target database")
     print()
@@ -202,20 +150,19 @@ def compare_databases(server, source_db, target_db):
     
     # Compare Tables
     print_header("[1/5] Comparing Application Tables...")
-    source_tables = get_tables(source_cursor)
-    target_tables = get_tables(target_cursor)
+    source_tables, target_tables = fetch_in_parallel(
+        get_tables, source_cursor, target_cursor, EXCLUDED_TABLES
+    )
     missing_tables, extra_tables = compare_lists(source_tables, target_tables, "table")
     
     if missing_tables or extra_tables:
         differences_found = True
         if missing_tables:
             print_error(f"  ✗ {len(missing_tables)} table(s) missing in target:")
-            for schema, table in sorted(missing_tables):
-                print_error(f"      - {schema}.{table}")
+            write_lines(fmt_error(f"      - {schema}.{table}") for schema, table in sorted(missing_tables))
         if extra_tables:
             print_warning(f"  ⚠ {len(extra_tables)} extra table(s) in target:")
-            for schema, table in sorted(extra_tables):
-                print_warning(f"      + {schema}.{table}")
+            write_lines(fmt_warning(f"      + {schema}.{table}") for schema, table in sorted(extra_tables))
     else:
         print_success(f"  ✓ All {len(source_tables)} application tables match")
     print()
@@ -223,25 +170,36 @@ def compare_databases(server, source_db, target_db):
     # Compare Row Counts
     if not missing_tables and not extra_tables:
         print_header("[2/5] Comparing Table Row Counts...")
-        print_info("  Counting rows in all tables...")
-        source_counts = get_table_row_counts(source_cursor, source_tables)
-        target_counts = get_table_row_counts(target_cursor, target_tables)
+        # Table lists match at this point, so both sides count the same tables
+        if exact_counts:
+            print_info("  Counting rows in each table...")
+            source_counts = get_exact_row_counts(server, source_db, source_tables)
+            target_counts = get_exact_row_counts(server, target_db, source_tables)
+        else:
+            print_info("  Reading row counts from partition metadata...")
+            source_counts, target_counts = fetch_in_parallel(
+                get_table_row_counts, source_cursor, target_cursor, source_tables
+            )
         
         row_count_diffs = []
-        for table_key in source_tables:
+        for table_key in sorted(source_tables):
             source_count = source_counts.get(table_key)
             target_count = target_counts.get(table_key)
-            if source_count != target_count:
+            # A failed count can't be verified, even if both sides failed
+            if source_count is None or source_count != target_count:
                 row_count_diffs.append((table_key, source_count, target_count))
         
         if row_count_diffs:
             differences_found = True
             print_error(f"  ✗ {len(row_count_diffs)} table(s) have different row counts:")
-            for (schema, table), source_count, target_count in row_count_diffs:
-                print_error(f"      {schema}.{table}: Source={source_count}, Target={target_count}")
+            write_lines(
+                fmt_error(f"      {schema}.{table}: Source={source_count}, Target={target_count}")
+                for (schema, table), source_count, target_count in row_count_diffs
+            )
         else:
-            total_rows = sum(source_counts.values())
-            print_success(f"  ✓ All table row counts match (~{total_rows:,} total rows)")
+            total_rows = sum(count for count in source_counts.values() if count is not None)
+            approx = "" if exact_counts else "~"
+            print_success(f"  ✓ All table row counts match ({approx}{total_rows:,} total rows)")
         print()
     else:
         print_warning("[2/5] Skipping row count comparison (table structure mismatch)")
@@ -249,40 +207,36 @@ def compare_databases(server, source_db, target_db):
     
     # Compare Views
     print_header("[3/5] Comparing Views...")
-    source_views = get_views(source_cursor)
-    target_views = get_views(target_cursor)
+    source_views, target_views = fetch_in_parallel(get_views, source_cursor, target_cursor)
     missing_views, extra_views = compare_lists(source_views, target_views, "view")
     
     if missing_views or extra_views:
         differences_found = True
         if missing_views:
             print_error(f"  ✗ {len(missing_views)} view(s) missing in target:")
-            for schema, view in sorted(missing_views):
-                print_error(f"      - {schema}.{view}")
+            write_lines(fmt_error(f"      - {schema}.{view}") for schema, view in sorted(missing_views))
         if extra_views:
             print_warning(f"  ⚠ {len(extra_views)} extra view(s) in target:")
-            for schema, view in sorted(extra_views):
-                print_warning(f"      + {schema}.{view}")
+            write_lines(fmt_warning(f"      + {schema}.{view}") for schema, view in sorted(extra_views))
     else:
         print_success(f"  ✓ All {len(source_views)} views match")
     print()
     
     # Compare Stored Procedures
     print_header("[4/5] Comparing Application Stored Procedures...")
-    source_procs = get_procedures(source_cursor)
-    target_procs = get_procedures(target_cursor)
+    source_procs, target_procs = fetch_in_parallel(
+        get_procedures, source_cursor, target_cursor, EXCLUDED_PROCEDURES
+    )
     missing_procs, extra_procs = compare_lists(source_procs, target_procs, "procedure")
     
     if missing_procs or extra_procs:
         differences_found = True
         if missing_procs:
             print_error(f"  ✗ {len(missing_procs)} procedure(s) missing in target:")
-            for schema, proc in sorted(missing_procs):
-                print_error(f"      - {schema}.{proc}")
+            write_lines(fmt_error(f"      - {schema}.{proc}") for schema, proc in sorted(missing_procs))
         if extra_procs:
             print_warning(f"  ⚠ {len(extra_procs)} extra procedure(s) in target:")
-            for schema, proc in sorted(extra_procs):
-                print_warning(f"      + {schema}.{proc}")
+            write_lines(fmt_warning(f"      + {schema}.{proc}") for schema, proc in sorted(extra_procs))
     else:
         if len(source_procs) > 0:
             print_success(f"  ✓ All {len(source_procs)} procedures match")
@@ -292,20 +246,19 @@ def compare_databases(server, source_db, target_db):
     
     # Compare Functions
     print_header("[5/5] Comparing Application Functions...")
-    source_funcs = get_functions(source_cursor)
-    target_funcs = get_functions(target_cursor)
+    source_funcs, target_funcs = fetch_in_parallel(
+        get_functions, source_cursor, target_cursor, EXCLUDED_FUNCTIONS
+    )
     missing_funcs, extra_funcs = compare_lists(source_funcs, target_funcs, "function")
     
     if missing_funcs or extra_funcs:
         differences_found = True
         if missing_funcs:
             print_error(f"  ✗ {len(missing_funcs)} function(s) missing in target:")
-            for schema, func in sorted(missing_funcs):
-                print_error(f"      - {schema}.{func}")
+            write_lines(fmt_error(f"      - {schema}.{func}") for schema, func in sorted(missing_funcs))
         if extra_funcs:
             print_warning(f"  ⚠ {len(extra_funcs)} extra function(s) in target:")
-            for schema, func in sorted(extra_funcs):
-                print_warning(f"      + {schema}.{func}")
+            write_lines(fmt_warning(f"      + {schema}.{func}") for schema, func in sorted(extra_funcs))
     else:
         if len(source_funcs) > 0:
             print_success(f"  ✓ All {len(source_funcs)} functions match")
@@ -313,11 +266,9 @@ def compare_databases(server, source_db, target_db):
             print_info(f"  ℹ No application functions in either database")
     print()
     
-    # Close connections
+    # Close cursors; cached connections are closed at exit
     source_cursor.close()
     target_cursor.close()
-    source_conn.close()
-    target_conn.close()
     
     # Summary
     print_header("=" * 80)
@@ -380,11 +331,13 @@ Prerequisites:
     parser.add_argument("--server", required=True, help="SQL Server FQDN")
     parser.add_argument("--source-db", required=True, help="Source database name")
     parser.add_argument("--target-db", required=True, help="Target database name")
+    parser.add_argument("--exact-counts", action="store_true",
+                        help="Count rows with COUNT_BIG(*) instead of reading partition metadata")
     
     args = parser.parse_args()
     
     # Run comparison
-    success = compare_databases(args.server, args.source_db, args.target_db)
+    success = compare_databases(args.server, args.source_db, args.target_db, args.exact_counts)
     
     sys.exit(0 if success else 1)
 
@@ -17,139 +17,86 @@ Usage:
 
 import argparse
 import sys
-import struct
-import pyodbc
-from azure.identity import AzureCliCredential
 from collections import defaultdict
+from _compare_common import (
+    create_connection, fetch_in_parallel, compare_lists,
+    print_header, print_success, print_error, print_warning, print_info,
+    fmt_error, fmt_warning, write_lines,
+)
 
-# ANSI color codes
-class Colors:
-    RED = '\033[0;31m'
-    GREEN = '\033[0;32m'
-    YELLOW = '\033[1;33m'
-    CYAN = '\033[0;36m'
-    GRAY = '\033[0;37m'
-    BOLD = '\033[1m'
-    NC = '\033[0m'
-
-def print_header(message):
-    print(f"{Colors.CYAN}{Colors.BOLD}{message}{Colors.NC}")
-
-def print_success(message):
-    print(f"{Colors.GREEN}{message}{Colors.NC}")
-
-def print_error(message):
-    print(f"{Colors.RED}{message}{Colors.NC}")
-
-def print_warning(message):
-    print(f"{Colors.YELLOW}{message}{Colors.NC}")
-
-def print_info(message):
-    print(f"{Colors.GRAY}{message}{Colors.NC}")
-
-def get_azure_sql_token():
-    """Get Azure AD access token for SQL Database."""
-    try:
-        credential = AzureCliCredential()
-        token = credential.get_token("https://database.windows.net/.default")
-        return token.token
-    except Exception as e:
-        print_error(f"Failed to get Azure AD token: {e}")
-        return None
-
-def create_connection(server, database):
-    """Create a connection to Azure SQL Database using Azure AD token."""
-    try:
-        token = get_azure_sql_token()
-        if not token:
-            return None
-        
-        token_bytes = token.encode('utf-16-le')
-        token_struct = struct.pack(f'<I{len(token_bytes)}s', len(token_bytes), token_bytes)
-        
-        connection_string = (
-            f"DRIVER={{ODBC Driver 18 for SQL Server}};"
-            f"SERVER={server};"
-            f"DATABASE={database};"
-            f"Encrypt=yes;"
-            f"TrustServerCertificate=no;"
-        )
-        
-        conn = pyodbc.connect(connection_string, attrs_before={1256: token_struct})
-        return conn
-    except Exception as e:
-        print_error(f"Failed to connect to {database}: {e}")
-        return None
-
-def get_tables(cursor):
-    """Get list of all tables."""
-    cursor.execute("""
+# Catalog queries, sent to each database as a single batch
+CATALOG_QUERIES = [
+    ('tables', """
         SELECT TABLE_SCHEMA, TABLE_NAME
         FROM INFORMATION_SCHEMA.TABLES
         WHERE TABLE_TYPE = 'BASE TABLE'
-        ORDER BY TABLE_SCHEMA, TABLE_NAME
-    """)
-    return [(row[0], row[1]) for row in cursor.fetchall()]
-
-def get_views(cursor):
-    """Get list of all views."""
-    cursor.execute("""
+    """),
+    ('views', """
         SELECT TABLE_SCHEMA, TABLE_NAME
         FROM INFORMATION_SCHEMA.VIEWS
-        ORDER BY TABLE_SCHEMA, TABLE_NAME
-    """)
-    return [(row[0], row[1]) for row in cursor.fetchall()]
-
-def get_procedures(cursor):
-    """Get list of all stored procedures."""
-    cursor.execute("""
+    """),
+    ('procedures', """
         SELECT ROUTINE_SCHEMA, ROUTINE_NAME
         FROM INFORMATION_SCHEMA.ROUTINES
         WHERE ROUTINE_TYPE = 'PROCEDURE'
-        ORDER BY ROUTINE_SCHEMA, ROUTINE_NAME
-    """)
-    return [(row[0], row[1]) for row in cursor.fetchall()]
-
-def get_functions(cursor):
-    """Get list of all functions."""
-    cursor.execute("""
+    """),
+    ('functions', """
         SELECT ROUTINE_SCHEMA, ROUTINE_NAME
         FROM INFORMATION_SCHEMA.ROUTINES
         WHERE ROUTINE_TYPE = 'FUNCTION'
-        ORDER BY ROUTINE_SCHEMA, ROUTINE_NAME
-    """)
-    return [(row[0], row[1]) for row in cursor.fetchall()]
-
-def get_indexes(cursor):
-    """Get list of all indexes with their tables."""
-    cursor.execute("""
+    """),
+    # Indexes and constraints share one result set, discriminated by kind
+    ('table_objects', """
         SELECT 
+            'index' AS Kind,
             s.name AS SchemaName,
             t.name AS TableName,
-            i.name AS IndexName,
-            i.type_desc AS IndexType,
+            i.name AS ObjectName,
+            i.type_desc AS ObjectType,
             i.is_unique,
             i.is_primary_key
         FROM sys.indexes i
         INNER JOIN sys.tables t ON i.object_id = t.object_id
         INNER JOIN sys.schemas s ON t.schema_id = s.schema_id
         WHERE i.type > 0  -- Exclude heaps
-        ORDER BY s.name, t.name, i.name
-    """)
-    return [(row[0], row[1], row[2], row[3], row[4], row[5]) for row in cursor.fetchall()]
-
-def get_constraints(cursor):
-    """Get list of all constraints."""
-    cursor.execute("""
+        UNION ALL
         SELECT 
+            'constraint',
             tc.TABLE_SCHEMA,
             tc.TABLE_NAME,
             tc.CONSTRAINT_NAME,
-            tc.CONSTRAINT_TYPE
+            tc.CONSTRAINT_TYPE,
+            NULL,
+            NULL
         FROM INFORMATION_SCHEMA.TABLE_CONSTRAINTS tc
-        ORDER BY tc.TABLE_SCHEMA, tc.TABLE_NAME, tc.CONSTRAINT_NAME
-    """)
-    return [(row[0], row[1], row[2], row[3]) for row in cursor.fetchall()]
+    """),
+]
+
+def fetch_all_catalog(cursor):
+    """Get tables, views, procedures, functions, indexes and constraints in one round-trip.
+    
+    Returns a dict keyed by catalog kind. Each kind is a frozenset of row
+    tuples, except indexes: a dict mapping (schema, table, index_name) to
+    (index_type, is_unique, is_primary_key), whose keys() serve as the
+    set to compare and whose values provide the reporting details.
+    """
+    cursor.execute(";".join(query for _, query in CATALOG_QUERIES))
+    catalog = {}
+    for kind, _ in CATALOG_QUERIES:
+        if kind == 'table_objects':
+            indexes = {}
+            constraints = set()
+            for row in cursor:
+                if row[0] == 'index':
+                    indexes[(row[1], row[2], row[3])] = (row[4], row[5], row[6])
+                else:
+                    constraints.add((row[1], row[2], row[3], row[4]))
+            catalog['indexes'] = indexes
+            catalog['constraints'] = frozenset(constraints)
+        else:
+            catalog[kind] = frozenset(tuple(row) for row in cursor)
+        cursor.nextset()
+    return catalog
 
 def get_table_columns(cursor, schema, table):
     """Get columns for a specific table."""
@@ -163,17 +110,7 @@ def get_table_columns(cursor, schema, table):
         WHERE TABLE_SCHEMA = ? AND TABLE_NAME = ?
         ORDER BY ORDINAL_POSITION
     """, schema, table)
-    return [(row[0], row[1], row[2], row[3]) for row in cursor.fetchall()]
-
-def compare_lists(source_list, target_list, item_name):
-    """Compare two lists and return differences."""
-    source_set = set(source_list)
-    target_set = set(target_list)
-    
-    missing_in_target = source_set - target_set
-    extra_in_target = target_set - source_set
-    
-    return missing_in_target, extra_in_target
+    return [(row[0], row[1], row[2], row[3]) for row in cursor]
 
 def compare_databases(server, source_db, target_db):
     """Compare two databases and show differences."""
@@ -202,7 +139,6 @@ def compare_databases(server, source_db, target_db):
     target_conn = create_connection(server, target_db)
     if not target_conn:
         print_error("Failed to connect to target database")
-        source_conn.close()
         return False
     print_success("✓ Connected to target database")
     print()
@@ -212,135 +148,121 @@ def compare_databases(server, source_db, target_db):
     
     differences_found = False
     
+    print_info("Fetching catalogs...")
+    source_catalog, target_catalog = fetch_in_parallel(fetch_all_catalog, source_cursor, target_cursor)
+    print()
+    
     # Compare Tables
     print_header("[1/6] Comparing Tables...")
-    source_tables = get_tables(source_cursor)
-    target_tables = get_tables(target_cursor)
+    source_tables = source_catalog['tables']
+    target_tables = target_catalog['tables']
     missing_tables, extra_tables = compare_lists(source_tables, target_tables, "table")
     
     if missing_tables or extra_tables:
         differences_found = True
         if missing_tables:
             print_error(f"  ✗ {len(missing_tables)} table(s) missing in target:")
-            for schema, table in sorted(missing_tables):
-                print_error(f"      - {schema}.{table}")
+            write_lines(fmt_error(f"      - {schema}.{table}") for schema, table in sorted(missing_tables))
         if extra_tables:
             print_warning(f"  ⚠ {len(extra_tables)} extra table(s) in target:")
-            for schema, table in sorted(extra_tables):
-                print_warning(f"      + {schema}.{table}")
+            write_lines(fmt_warning(f"      + {schema}.{table}") for schema, table in sorted(extra_tables))
     else:
         print_success(f"  ✓ All {len(source_tables)} tables match")
     print()
     
     # Compare Views
     print_header("[2/6] Comparing Views...")
-    source_views = get_views(source_cursor)
-    target_views = get_views(target_cursor)
+    source_views = source_catalog['views']
+    target_views = target_catalog['views']
     missing_views, extra_views = compare_lists(source_views, target_views, "view")
     
     if missing_views or extra_views:
         differences_found = True
         if missing_views:
             print_error(f"  ✗ {len(missing_views)} view(s) missing in target:")
-            for schema, view in sorted(missing_views):
-                print_error(f"      - {schema}.{view}")
+            write_lines(fmt_error(f"      - {schema}.{view}") for schema, view in sorted(missing_views))
         if extra_views:
             print_warning(f"  ⚠ {len(extra_views)} extra view(s) in target:")
-            for schema, view in sorted(extra_views):
-                print_warning(f"      + {schema}.{view}")
+            write_lines(fmt_warning(f"      + {schema}.{view}") for schema, view in sorted(extra_views))
     else:
         print_success(f"  ✓ All {len(source_views)} views match")
     print()
     
     # Compare Stored Procedures
     print_header("[3/6] Comparing Stored Procedures...")
-    source_procs = get_procedures(source_cursor)
-    target_procs = get_procedures(target_cursor)
+    source_procs = source_catalog['procedures']
+    target_procs = target_catalog['procedures']
     missing_procs, extra_procs = compare_lists(source_procs, target_procs, "procedure")
     
     if missing_procs or extra_procs:
         differences_found = True
         if missing_procs:
             print_error(f"  ✗ {len(missing_procs)} procedure(s) missing in target:")
-            for schema, proc in sorted(missing_procs):
-                print_error(f"      - {schema}.{proc}")
+            write_lines(fmt_error(f"      - {schema}.{proc}") for schema, proc in sorted(missing_procs))
         if extra_procs:
             print_warning(f"  ⚠ {len(extra_procs)} extra procedure(s) in target:")
-            for schema, proc in sorted(extra_procs):
-                print_warning(f"      + {schema}.{proc}")
+            write_lines(fmt_warning(f"      + {schema}.{proc}") for schema, proc in sorted(extra_procs))
     else:
         print_success(f"  ✓ All {len(source_procs)} procedures match")
     print()
     
     # Compare Functions
     print_header("[4/6] Comparing Functions...")
-    source_funcs = get_functions(source_cursor)
-    target_funcs = get_functions(target_cursor)
+    source_funcs = source_catalog['functions']
+    target_funcs = target_catalog['functions']
     missing_funcs, extra_funcs = compare_lists(source_funcs, target_funcs, "function")
     
     if missing_funcs or extra_funcs:
         differences_found = True
         if missing_funcs:
             print_error(f"  ✗ {len(missing_funcs)} function(s) missing in target:")
-            for schema, func in sorted(missing_funcs):
-                print_error(f"      - {schema}.{func}")
+            write_lines(fmt_error(f"      - {schema}.{func}") for schema, func in sorted(missing_funcs))
         if extra_funcs:
             print_warning(f"  ⚠ {len(extra_funcs)} extra function(s) in target:")
-            for schema, func in sorted(extra_funcs):
-                print_warning(f"      + {schema}.{func}")
+            write_lines(fmt_warning(f"      + {schema}.{func}") for schema, func in sorted(extra_funcs))
     else:
         print_success(f"  ✓ All {len(source_funcs)} functions match")
     print()
     
     # Compare Indexes
     print_header("[5/6] Comparing Indexes...")
-    source_indexes = get_indexes(source_cursor)
-    target_indexes = get_indexes(target_cursor)
-    
-    # Create comparable tuples (schema, table, index_name)
-    source_idx_set = set([(idx[0], idx[1], idx[2]) for idx in source_indexes])
-    target_idx_set = set([(idx[0], idx[1], idx[2]) for idx in target_indexes])
+    source_indexes = source_catalog['indexes']
+    target_indexes = target_catalog['indexes']
     
-    missing_indexes = source_idx_set - target_idx_set
-    extra_indexes = target_idx_set - source_idx_set
+    # Compare on (schema, table, index_name)
+    missing_indexes, extra_indexes = compare_lists(source_indexes.keys(), target_indexes.keys(), "index")
     
     if missing_indexes or extra_indexes:
         differences_found = True
         if missing_indexes:
             print_error(f"  ✗ {len(missing_indexes)} index(es) missing in target:")
+            lines = []
             for schema, table, idx_name in sorted(missing_indexes):
-                # Find details from source
-                details = [idx for idx in source_indexes if idx[0] == schema and idx[1] == table and idx[2] == idx_name]
+                details = source_indexes.get((schema, table, idx_name))
                 if details:
-                    idx_type = details[0][3]
-                    is_unique = details[0][4]
-                    is_pk = details[0][5]
+                    idx_type, is_unique, is_pk = details
                     flags = []
                     if is_pk:
                         flags.append("PRIMARY KEY")
                     if is_unique:
                         flags.append("UNIQUE")
                     flag_str = f" ({', '.join(flags)})" if flags else ""
-                    print_error(f"      - {schema}.{table}.{idx_name} [{idx_type}]{flag_str}")
+                    lines.append(fmt_error(f"      - {schema}.{table}.{idx_name} [{idx_type}]{flag_str}"))
+            write_lines(lines)
         if extra_indexes:
             print_warning(f"  ⚠ {len(extra_indexes)} extra index(es) in target:")
-            for schema, table, idx_name in sorted(extra_indexes):
-                print_warning(f"      + {schema}.{table}.{idx_name}")
+            write_lines(fmt_warning(f"      + {schema}.{table}.{idx_name}")
+                        for schema, table, idx_name in sorted(extra_indexes))
     else:
         print_success(f"  ✓ All {len(source_indexes)} indexes match")
     print()
     
     # Compare Constraints
     print_header("[6/6] Comparing Constraints...")
-    source_constraints = get_constraints(source_cursor)
-    target_constraints = get_constraints(target_cursor)
-    
-    # Create comparable tuples
-    source_const_set = set([(c[0], c[1], c[2], c[3]) for c in source_constraints])
-    target_const_set = set([(c[0], c[1], c[2], c[3]) for c in target_constraints])
+    source_constraints = source_catalog['constraints']
+    target_constraints = target_catalog['constraints']
     
-    missing_constraints = source_const_set - target_const_set
-    extra_constraints = target_const_set - source_const_set
+    missing_constraints, extra_constraints = compare_lists(source_constraints, target_constraints, "constraint")
     
     if missing_constraints or extra_constraints:
         differences_found = True
@@ -351,24 +273,24 @@ def compare_databases(server, source_db, target_db):
             for schema, table, const_name, const_type in sorted(missing_constraints):
                 by_type[const_type].append((schema, table, const_name))
             
+            lines = []
             for const_type, items in sorted(by_type.items()):
-                print_error(f"      {const_type}:")
-                for schema, table, const_name in items:
-                    print_error(f"        - {schema}.{table}.{const_name}")
+                lines.append(fmt_error(f"      {const_type}:"))
+                lines.extend(fmt_error(f"        - {schema}.{table}.{const_name}")
+                             for schema, table, const_name in items)
+            write_lines(lines)
         
         if extra_constraints:
             print_warning(f"  ⚠ {len(extra_constraints)} extra constraint(s) in target:")
-            for schema, table, const_name, const_type in sorted(extra_constraints):
-                print_warning(f"      + {schema}.{table}.{const_name} [{const_type}]")
+            write_lines(fmt_warning(f"      + {schema}.{table}.{const_name} [{const_type}]")
+                        for schema, table, const_name, const_type in sorted(extra_constraints))
     else:
         print_success(f"  ✓ All {len(source_constraints)} constraints match")
     print()
     
-    # Close connections
+    # Close cursors; cached connections are closed at exit
     source_cursor.close()
     target_cursor.close()
-    source_conn.close()
-    target_conn.close()
     
     # Summary
     print_header("=" * 80)
@@ -8,6 +8,7 @@ accessibility, and health checks.
 
 Requirements:
     pip install pyodbc azure-identity
+    _compare_common.py in the same directory
 
 Usage:
     python validate-database-integrity.py \
@@ -18,11 +19,15 @@ Usage:
 """
 
 import argparse
+import atexit
+import json
+import os
 import sys
-import struct
+import tempfile
+import time
 import pyodbc
 from azure.identity import DefaultAzureCredential, AzureCliCredential
-from datetime import datetime
+from _compare_common import CONNECTION_STRING_TEMPLATE, get_token_struct, close_connections
 
 # ANSI color codes
 class Colors:
@@ -33,94 +38,215 @@ class Colors:
     GRAY = '\033[0;37m'
     NC = '\033[0m'  # No Color
 
+# Every check prints several progress lines; write them without print()'s overhead
+_write = sys.stdout.write
+_HEADER_TEMPLATE = f"{Colors.CYAN}%s{Colors.NC}\n"
+_SUCCESS_TEMPLATE = f"{Colors.GREEN}%s{Colors.NC}\n"
+_ERROR_TEMPLATE = f"{Colors.RED}%s{Colors.NC}\n"
+_WARNING_TEMPLATE = f"{Colors.YELLOW}%s{Colors.NC}\n"
+_INFO_TEMPLATE = f"{Colors.GRAY}%s{Colors.NC}\n"
+
 def print_header(message):
     """Print a cyan header message."""
-    print(f"{Colors.CYAN}{message}{Colors.NC}")
+    _write(_HEADER_TEMPLATE % (message,))
 
 def print_success(message):
     """Print a green success message."""
-    print(f"{Colors.GREEN}{message}{Colors.NC}")
+    _write(_SUCCESS_TEMPLATE % (message,))
 
 def print_error(message):
     """Print a red error message."""
-    print(f"{Colors.RED}{message}{Colors.NC}")
+    _write(_ERROR_TEMPLATE % (message,))
 
 def print_warning(message):
     """Print a yellow warning message."""
-    print(f"{Colors.YELLOW}{message}{Colors.NC}")
+    _write(_WARNING_TEMPLATE % (message,))
 
 def print_info(message):
     """Print a gray info message."""
-    print(f"{Colors.GRAY}{message}{Colors.NC}")
+    _write(_INFO_TEMPLATE % (message,))
+
+def print_info_lines(messages):
+    """Print several gray info messages with a single write."""
+    _write("".join([_INFO_TEMPLATE % (message,) for message in messages]))
+
+# ODBC connection attributes set before connecting
+SQL_COPT_SS_ACCESS_TOKEN = 1256
+SQL_ATTR_PACKET_SIZE = 112
+
+# Largest TDS packet size SQL Server accepts, so result sets need fewer packets
+PACKET_SIZE = 32767
+
+SQL_TOKEN_SCOPE = "https://database.windows.net/.default"
+
+# Access tokens are reused across runs from this file until shortly before expiry
+TOKEN_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".cache", "azsql_token.json")
+TOKEN_REFRESH_MARGIN = 60
+
+# Token for the current process, as (token, expires_on)
+_sql_token = None
+
+# Whether _sql_token was read from TOKEN_CACHE_FILE rather than fetched from 'az'
+_sql_token_from_disk = False
+
+# SQLSTATE returned when the server rejects the login
+SQLSTATE_LOGIN_FAILED = "28000"
+
+def load_cached_token():
+    """Load a still-valid access token from the token cache file."""
+    try:
+        with open(TOKEN_CACHE_FILE) as f:
+            cached = json.load(f)
+        if cached.get("scope") != SQL_TOKEN_SCOPE:
+            return None
+        if time.time() >= cached["expires_on"] - TOKEN_REFRESH_MARGIN:
+            return None
+        return cached["token"], cached["expires_on"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+def save_cached_token(token, expires_on):
+    """Write an access token to the token cache file, readable only by the owner."""
+    cache_dir = os.path.dirname(TOKEN_CACHE_FILE)
+    try:
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        # mkstemp always creates a fresh 0600 file; replacing the cache with it
+        # keeps an existing file's wider permissions from ever applying to the token
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=".azsql_token.")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump({"scope": SQL_TOKEN_SCOPE, "token": token, "expires_on": expires_on}, f)
+            os.replace(tmp_path, TOKEN_CACHE_FILE)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    except OSError as e:
+        print_warning(f"      Could not cache Azure AD token: {e}")
 
-def get_azure_sql_token():
-    """Get Azure AD access token for SQL Database."""
+def get_azure_sql_token(use_cache=True):
+    """
+    Get Azure AD access token for SQL Database.
+    
+    The token is kept for the rest of the process and, unless use_cache is
+    False, in TOKEN_CACHE_FILE so later runs skip the Azure CLI call.
+    """
+    global _sql_token, _sql_token_from_disk
+    if _sql_token is not None and time.time() < _sql_token[1] - TOKEN_REFRESH_MARGIN:
+        return _sql_token[0]
+    
+    if use_cache:
+        _sql_token = load_cached_token()
+        _sql_token_from_disk = _sql_token is not None
+        if _sql_token is not None:
+            return _sql_token[0]
+    
     try:
         # Try Azure CLI credential first (most common for scripts)
         credential = AzureCliCredential()
-        token = credential.get_token("https://database.windows.net/.default")
-        return token.token
+        token = credential.get_token(SQL_TOKEN_SCOPE)
     except Exception as e:
         print_error(f"Failed to get Azure AD token: {e}")
         print_info("Make sure you're logged in: az login")
         return None
+    
+    _sql_token = (token.token, token.expires_on)
+    if use_cache:
+        save_cached_token(token.token, token.expires_on)
+    return token.token
 
-def create_connection(server, database, username=None, password=None, use_managed_identity=False):
+def discard_cached_token():
+    """
+    Forget a token read from TOKEN_CACHE_FILE and delete the file.
+    
+    Returns True if there was such a token, so the caller can retry the
+    login once with a fresh token from the Azure CLI.
+    """
+    global _sql_token, _sql_token_from_disk
+    if not _sql_token_from_disk:
+        return False
+    _sql_token = None
+    _sql_token_from_disk = False
+    try:
+        os.remove(TOKEN_CACHE_FILE)
+    except OSError:
+        pass
+    return True
+
+SQL_AUTH_CONNECTION_STRING_TEMPLATE = CONNECTION_STRING_TEMPLATE + "UID={username};PWD={password};"
+
+def odbc_quote(value):
+    """Brace-quote a connection string value so ';' or '}' in it can't break the string."""
+    return "{" + value.replace("}", "}}") + "}"
+
+# Open connections keyed by (server, database, auth method, username)
+_connections = {}
+
+def create_connection(server, database, username=None, password=None, use_managed_identity=False,
+                      use_token_cache=True):
     """
     Create a connection to Azure SQL Database.
     
+    Connections are cached per server, database and login, so repeated
+    validations in one process skip the TLS handshake and authentication.
+    
     Args:
         server: SQL Server FQDN (e.g., myserver.database.windows.net)
         database: Database name
         username: SQL or Azure AD username (optional)
         password: Password (optional)
         use_managed_identity: Use Azure AD token authentication
+        use_token_cache: Reuse Azure AD tokens cached on disk by earlier runs
     
     Returns:
         pyodbc.Connection or None
     """
+    use_azure_ad = use_managed_identity or (not username and not password)
+    key = (server, database, "aad" if use_azure_ad else "sql", None if use_azure_ad else username)
+    conn = _connections.get(key)
+    if conn is not None and not conn.closed:
+        print_info("      Reusing open connection")
+        return conn
+    
     try:
         # Build connection string based on auth method
-        if use_managed_identity or (not username and not password):
+        if use_azure_ad:
             # Use Azure AD token authentication
             print_info("      Using Azure AD token authentication...")
-            token = get_azure_sql_token()
-            if not token:
-                return None
+            connection_string = CONNECTION_STRING_TEMPLATE.format(server=server, database=database)
             
-            # Convert token to struct for SQL Server
-            token_bytes = token.encode('utf-16-le')
-            token_struct = struct.pack(f'<I{len(token_bytes)}s', len(token_bytes), token_bytes)
-            
-            connection_string = (
-                f"DRIVER={{ODBC Driver 18 for SQL Server}};"
-                f"SERVER={server};"
-                f"DATABASE={database};"
-                f"Encrypt=yes;"
-                f"TrustServerCertificate=no;"
-            )
-            
-            conn = pyodbc.connect(connection_string, attrs_before={1256: token_struct})
+            while True:
+                token = get_azure_sql_token(use_token_cache)
+                if not token:
+                    return None
+                
+                try:
+                    conn = pyodbc.connect(connection_string, attrs_before={
+                        SQL_COPT_SS_ACCESS_TOKEN: get_token_struct(token),
+                        SQL_ATTR_PACKET_SIZE: PACKET_SIZE,
+                    })
+                    break
+                except pyodbc.Error as e:
+                    # The cache file is keyed only by scope, so its token may belong
+                    # to a different 'az login'; drop it and retry once with a fresh one
+                    if e.args[0] != SQLSTATE_LOGIN_FAILED or not discard_cached_token():
+                        raise
+                    print_warning("      Cached Azure AD token was rejected, retrying with a fresh token...")
             print_success("      Connected using Azure AD authentication")
             
         elif username and password:
             # Use SQL authentication
             print_info(f"      Using SQL authentication for user: {username}")
-            connection_string = (
-                f"DRIVER={{ODBC Driver 18 for SQL Server}};"
-                f"SERVER={server};"
-                f"DATABASE={database};"
-                f"UID={username};"
-                f"PWD={password};"
-                f"Encrypt=yes;"
-                f"TrustServerCertificate=no;"
+            connection_string = SQL_AUTH_CONNECTION_STRING_TEMPLATE.format(
+                server=server, database=database,
+                username=odbc_quote(username), password=odbc_quote(password)
             )
-            conn = pyodbc.connect(connection_string)
+            conn = pyodbc.connect(connection_string, attrs_before={SQL_ATTR_PACKET_SIZE: PACKET_SIZE})
             print_success("      Connected using SQL authentication")
         else:
             print_error("      No authentication method provided")
             return None
         
+        _connections[key] = conn
         return conn
     
     except pyodbc.Error as e:
@@ -130,36 +256,179 @@ def create_connection(server, database, username=None, password=None, use_manage
         print_error(f"      Unexpected error during connection: {e}")
         return None
 
-def check_database_accessibility(cursor):
+def discard_connection(conn):
+    """Close a connection and drop it from the connection cache."""
+    for key, cached in list(_connections.items()):
+        if cached is conn:
+            del _connections[key]
+    try:
+        conn.close()
+    except pyodbc.Error:
+        pass
+
+atexit.register(close_connections, _connections)
+
+# Metadata queries for the checks, sent to the server as a single batch
+CHECK_QUERIES = [
+    ('accessibility', """
+        SELECT COUNT(*) AS TableCount 
+        FROM INFORMATION_SCHEMA.TABLES 
+        WHERE TABLE_TYPE = 'BASE TABLE'
+    """),
+    # Used space of the data files comes from the engine's counters when the caller
+    # has VIEW DATABASE STATE, and from FILEPROPERTY per data file otherwise
+    # (e.g. a db_datareader login), so the check never fails on permissions
+    ('size', """
+        IF HAS_PERMS_BY_NAME(DB_NAME(), 'DATABASE', 'VIEW DATABASE STATE') = 1
+            SELECT 
+                (SELECT SUM(allocated_extent_page_count) FROM sys.dm_db_file_space_usage) * 8 / 1024.0 AS UsedSpaceMB,
+                (SELECT SUM(CAST(size AS bigint)) FROM sys.database_files) * 8 / 1024.0 AS AllocatedSpaceMB
+        ELSE
+            SELECT 
+                (SELECT SUM(CAST(FILEPROPERTY(name, 'SpaceUsed') AS bigint)) FROM sys.database_files WHERE type = 0) * 8 / 1024.0 AS UsedSpaceMB,
+                (SELECT SUM(CAST(size AS bigint)) FROM sys.database_files) * 8 / 1024.0 AS AllocatedSpaceMB
+    """),
+    # Schema object, index and constraint counts for checks 3, 6 and 7
+    ('object_counts', """
+        SELECT o.*, i.*
+        FROM (
+            SELECT 
+                SUM(CASE WHEN type = 'U' THEN 1 ELSE 0 END) AS Tables,
+                SUM(CASE WHEN type = 'V' THEN 1 ELSE 0 END) AS Views,
+                SUM(CASE WHEN type IN ('P', 'PC') THEN 1 ELSE 0 END) AS Procedures,
+                SUM(CASE WHEN type IN ('FN', 'IF', 'TF', 'FS', 'FT') THEN 1 ELSE 0 END) AS Functions,
+                SUM(CASE WHEN type = 'F' THEN 1 ELSE 0 END) AS ForeignKeys,
+                SUM(CASE WHEN type = 'C' THEN 1 ELSE 0 END) AS CheckConstraints,
+                SUM(CASE WHEN type = 'UQ' THEN 1 ELSE 0 END) AS UniqueConstraints
+            FROM sys.objects
+        ) o
+        CROSS JOIN (
+            SELECT 
+                COUNT(*) AS IndexCount,
+                SUM(CASE WHEN is_unique = 1 THEN 1 ELSE 0 END) AS UniqueIndexes,
+                SUM(CASE WHEN is_primary_key = 1 THEN 1 ELSE 0 END) AS PrimaryKeys
+            FROM sys.indexes
+            WHERE type > 0  -- Exclude heaps
+        ) i
+    """),
+    ('table_totals', """
+        SELECT 
+            COUNT(DISTINCT t.object_id) AS TableCount,
+            SUM(p.rows) AS ApproxRowCount
+        FROM sys.tables t
+        INNER JOIN sys.partitions p ON t.object_id = p.object_id AND p.index_id IN (0,1)
+    """),
+    # Also supplies the table probed by check_data_accessibility
+    ('largest_tables', """
+        SELECT TOP 10 
+            s.name AS SchemaName,
+            t.name AS TableName,
+            SUM(p.rows) AS ApproxRowCount
+        FROM sys.tables t
+        INNER JOIN sys.schemas s ON t.schema_id = s.schema_id
+        INNER JOIN sys.partitions p ON t.object_id = p.object_id AND p.index_id IN (0,1)
+        GROUP BY s.name, t.name
+        ORDER BY ApproxRowCount DESC
+    """),
+    ('health', """
+        SELECT 
+            name,
+            state_desc,
+            recovery_model_desc,
+            compatibility_level
+        FROM sys.databases
+        WHERE name = DB_NAME()
+    """),
+]
+
+# Reads one row of a table without pulling back its columns, which may be LOBs.
+# The names are quoted server-side rather than spliced into the SQL, so the batch
+# text is identical for every table and database and its cached plan is reused.
+DATA_PROBE_QUERY = """
+    DECLARE @sql nvarchar(max) = N'SELECT TOP 1 1 FROM ' + QUOTENAME(?) + N'.' + QUOTENAME(?);
+    EXEC sp_executesql @sql;
+"""
+
+# Schema object counts rarely change, so repeated runs reuse them for this many seconds
+METADATA_CACHE_TTL = 60
+CACHED_CHECK_QUERIES = {'object_counts'}
+
+# Cached result rows keyed by (server, database, query name), as (expires_at, rows)
+_metadata_cache = {}
+
+def fetch_check_results(cursor, server, database):
+    """
+    Run every check query in one round-trip and collect the result sets.
+    
+    Results for CACHED_CHECK_QUERIES are reused from earlier runs against the
+    same database for up to METADATA_CACHE_TTL seconds and left out of the batch.
+    
+    Returns:
+        dict mapping each CHECK_QUERIES name to its list of rows, or to the
+        pyodbc.Error raised by that query
+    """
+    now = time.monotonic()
+    results = {}
+    for name in CACHED_CHECK_QUERIES:
+        cached = _metadata_cache.get((server, database, name))
+        if cached is not None and now < cached[0]:
+            results[name] = cached[1]
+    queries = [(name, query) for name, query in CHECK_QUERIES if name not in results]
+    
+    # The batch ends at the first failing statement: pyodbc raises and drops
+    # every result set after it. The error is recorded for the check whose
+    # statement failed, and only the queries after it are run one at a time.
+    fetched = {}
+    try:
+        cursor.execute(";".join(query for _, query in queries))
+        fetched[queries[0][0]] = cursor.fetchall()
+        for name, _ in queries[1:]:
+            cursor.nextset()
+            fetched[name] = cursor.fetchall()
+    except pyodbc.Error as e:
+        fetched[queries[len(fetched)][0]] = e
+    
+    for name, query in queries[len(fetched):]:
+        # The remaining checks are skipped when the database can't be queried
+        if isinstance(fetched.get('accessibility'), Exception):
+            break
+        try:
+            cursor.execute(query)
+            fetched[name] = cursor.fetchall()
+        except pyodbc.Error as e:
+            fetched[name] = e
+    
+    for name in CACHED_CHECK_QUERIES:
+        rows = fetched.get(name)
+        if isinstance(rows, list):
+            _metadata_cache[(server, database, name)] = (now + METADATA_CACHE_TTL, rows)
+    results.update(fetched)
+    return results
+
+def check_rows(result):
+    """Return the rows fetched for a check, raising the error if its query failed."""
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+def check_database_accessibility(result):
     """Check 1: Verify database is accessible and count tables."""
     print_info("      [Check 1/8] Verifying database accessibility...")
     try:
-        cursor.execute("""
-            SELECT COUNT(*) AS TableCount 
-            FROM INFORMATION_SCHEMA.TABLES 
-            WHERE TABLE_TYPE = 'BASE TABLE'
-        """)
-        row = cursor.fetchone()
-        table_count = row[0]
+        (table_count,) = check_rows(result)[0]
         print_success(f"        ✓ Database accessible - Found {table_count} tables")
         return True, table_count
     except Exception as e:
         print_error(f"        ✗ Failed to query database: {e}")
         return False, 0
 
-def check_database_size(cursor):
+def check_database_size(result):
     """Check 2: Get database size and space usage."""
     print_info("      [Check 2/8] Checking database size and space usage...")
     try:
-        cursor.execute("""
-            SELECT 
-                SUM(CAST(FILEPROPERTY(name, 'SpaceUsed') AS bigint) * 8192.) / 1024 / 1024 AS UsedSpaceMB,
-                SUM(size * 8192.) / 1024 / 1024 AS AllocatedSpaceMB
-            FROM sys.database_files
-        """)
-        row = cursor.fetchone()
-        used_mb = round(row[0], 2) if row[0] else 0
-        allocated_mb = round(row[1], 2) if row[1] else 0
+        used_mb, allocated_mb = check_rows(result)[0]
+        used_mb = round(used_mb, 2) if used_mb else 0
+        allocated_mb = round(allocated_mb, 2) if allocated_mb else 0
         
         print_success(f"        ✓ Used space: {used_mb} MB")
         print_info(f"          Allocated space: {allocated_mb} MB")
@@ -168,19 +437,11 @@ def check_database_size(cursor):
         print_warning(f"        ⚠ Could not determine database size: {e}")
         return False, 0, 0
 
-def check_schema_objects(cursor):
+def check_schema_objects(result):
     """Check 3: Validate schema objects (tables, views, procedures, functions)."""
     print_info("      [Check 3/8] Validating schema objects...")
     try:
-        cursor.execute("""
-            SELECT 
-                (SELECT COUNT(*) FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_TYPE = 'BASE TABLE') AS Tables,
-                (SELECT COUNT(*) FROM INFORMATION_SCHEMA.VIEWS) AS Views,
-                (SELECT COUNT(*) FROM INFORMATION_SCHEMA.ROUTINES WHERE ROUTINE_TYPE = 'PROCEDURE') AS Procedures,
-                (SELECT COUNT(*) FROM INFORMATION_SCHEMA.ROUTINES WHERE ROUTINE_TYPE = 'FUNCTION') AS Functions
-        """)
-        row = cursor.fetchone()
-        tables, views, procedures, functions = row[0], row[1], row[2], row[3]
+        tables, views, procedures, functions = check_rows(result)[0][0:4]
         
         print_success(f"        ✓ Tables: {tables}, Views: {views}, Procedures: {procedures}, Functions: {functions}")
         return True, {"tables": tables, "views": views, "procedures": procedures, "functions": functions}
@@ -188,37 +449,22 @@ def check_schema_objects(cursor):
         print_warning(f"        ⚠ Could not retrieve schema object counts: {e}")
         return False, {}
 
-def check_table_details(cursor):
+def check_table_details(totals_result, largest_result):
     """Check 4: Get detailed table information (names and row counts)."""
     print_info("      [Check 4/8] Analyzing table details...")
     try:
-        cursor.execute("""
-            SELECT 
-                t.TABLE_SCHEMA,
-                t.TABLE_NAME,
-                p.rows AS ApproxRowCount
-            FROM INFORMATION_SCHEMA.TABLES t
-            LEFT JOIN sys.tables st ON t.TABLE_NAME = st.name
-            LEFT JOIN sys.partitions p ON st.object_id = p.object_id AND p.index_id IN (0,1)
-            WHERE t.TABLE_TYPE = 'BASE TABLE'
-            ORDER BY p.rows DESC
-        """)
-        
-        tables = []
-        total_rows = 0
-        for row in cursor.fetchall():
-            schema = row[0]
-            table = row[1]
-            rows = row[2] if row[2] else 0
-            tables.append({"schema": schema, "table": table, "rows": rows})
-            total_rows += rows
+        table_count, total_rows = check_rows(totals_result)[0]
+        total_rows = total_rows or 0
+        tables = [{"schema": row[0], "table": row[1], "rows": row[2] or 0}
+                  for row in check_rows(largest_result)]
         
         if tables:
-            print_success(f"        ✓ Found {len(tables)} tables with ~{total_rows:,} total rows")
+            print_success(f"        ✓ Found {table_count} tables with ~{total_rows:,} total rows")
             # Show top 10 largest tables
-            print_info("          Top 10 largest tables:")
-            for i, tbl in enumerate(tables[:10], 1):
-                print_info(f"            {i}. {tbl['schema']}.{tbl['table']}: ~{tbl['rows']:,} rows")
+            print_info_lines(["          Top 10 largest tables:"] + [
+                f"            {i}. {tbl['schema']}.{tbl['table']}: ~{tbl['rows']:,} rows"
+                for i, tbl in enumerate(tables, 1)
+            ])
         else:
             print_warning("        ⚠ No tables found")
         
@@ -227,31 +473,19 @@ def check_table_details(cursor):
         print_warning(f"        ⚠ Could not retrieve table details: {e}")
         return False, []
 
-def check_data_accessibility(cursor):
+def check_data_accessibility(cursor, result):
     """Check 5: Verify data can be read from tables."""
     print_info("      [Check 5/8] Verifying data accessibility...")
     try:
-        # Get first table with data
-        cursor.execute("""
-            SELECT TOP 1 
-                t.TABLE_SCHEMA,
-                t.TABLE_NAME
-            FROM INFORMATION_SCHEMA.TABLES t
-            INNER JOIN sys.tables st ON t.TABLE_NAME = st.name
-            INNER JOIN sys.partitions p ON st.object_id = p.object_id AND p.index_id IN (0,1)
-            WHERE t.TABLE_TYPE = 'BASE TABLE' AND p.rows > 0
-            ORDER BY p.rows DESC
-        """)
-        
-        row = cursor.fetchone()
-        if not row:
+        # Largest table, found by the batched metadata query
+        rows = check_rows(result)
+        if not rows or not rows[0][2]:
             print_warning("        ⚠ No tables with data found")
             return False
         
-        schema, table = row[0], row[1]
+        schema, table, _ = rows[0]
         
-        # Try to query the table
-        cursor.execute(f"SELECT TOP 1 * FROM [{schema}].[{table}]")
+        cursor.execute(DATA_PROBE_QUERY, schema, table)
         cursor.fetchone()
         
         print_success(f"        ✓ Data is accessible (tested with {schema}.{table})")
@@ -260,23 +494,11 @@ def check_data_accessibility(cursor):
         print_error(f"        ✗ Could not verify data accessibility: {e}")
         return False
 
-def check_indexes(cursor):
+def check_indexes(result):
     """Check 6: Verify indexes exist and get statistics."""
     print_info("      [Check 6/8] Checking indexes...")
     try:
-        cursor.execute("""
-            SELECT 
-                COUNT(*) AS IndexCount,
-                SUM(CASE WHEN is_unique = 1 THEN 1 ELSE 0 END) AS UniqueIndexes,
-                SUM(CASE WHEN is_primary_key = 1 THEN 1 ELSE 0 END) AS PrimaryKeys
-            FROM sys.indexes
-            WHERE type > 0  -- Exclude heaps
-        """)
-        
-        row = cursor.fetchone()
-        index_count = row[0]
-        unique_indexes = row[1]
-        primary_keys = row[2]
+        index_count, unique_indexes, primary_keys = check_rows(result)[0][7:10]
         
         print_success(f"        ✓ Indexes: {index_count} (Unique: {unique_indexes}, Primary Keys: {primary_keys})")
         return True, index_count
@@ -284,21 +506,11 @@ def check_indexes(cursor):
         print_warning(f"        ⚠ Could not retrieve index information: {e}")
         return False, 0
 
-def check_constraints(cursor):
+def check_constraints(result):
     """Check 7: Verify constraints (foreign keys, checks, etc.)."""
     print_info("      [Check 7/8] Checking constraints...")
     try:
-        cursor.execute("""
-            SELECT 
-                (SELECT COUNT(*) FROM INFORMATION_SCHEMA.TABLE_CONSTRAINTS WHERE CONSTRAINT_TYPE = 'FOREIGN KEY') AS ForeignKeys,
-                (SELECT COUNT(*) FROM INFORMATION_SCHEMA.TABLE_CONSTRAINTS WHERE CONSTRAINT_TYPE = 'CHECK') AS CheckConstraints,
-                (SELECT COUNT(*) FROM INFORMATION_SCHEMA.TABLE_CONSTRAINTS WHERE CONSTRAINT_TYPE = 'UNIQUE') AS UniqueConstraints
-        """)
-        
-        row = cursor.fetchone()
-        fk_count = row[0]
-        check_count = row[1]
-        unique_count = row[2]
+        fk_count, check_count, unique_count = check_rows(result)[0][4:7]
         
         print_success(f"        ✓ Foreign Keys: {fk_count}, Check Constraints: {check_count}, Unique Constraints: {unique_count}")
         return True
@@ -306,26 +518,12 @@ def check_constraints(cursor):
         print_warning(f"        ⚠ Could not retrieve constraint information: {e}")
         return False
 
-def check_database_health(cursor):
+def check_database_health(result):
     """Check 8: Overall database health and corruption check."""
     print_info("      [Check 8/8] Performing database health check...")
     try:
-        # Check database options
-        cursor.execute("""
-            SELECT 
-                name,
-                state_desc,
-                recovery_model_desc,
-                compatibility_level
-            FROM sys.databases
-            WHERE name = DB_NAME()
-        """)
-        
-        row = cursor.fetchone()
-        db_name = row[0]
-        state = row[1]
-        recovery_model = row[2]
-        compat_level = row[3]
+        # Database options
+        db_name, state, recovery_model, compat_level = check_rows(result)[0]
         
         if state == "ONLINE":
             print_success(f"        ✓ Database state: {state}")
@@ -340,7 +538,8 @@ def check_database_health(cursor):
         print_warning(f"        ⚠ Could not check database health: {e}")
         return False
 
-def run_integrity_checks(server, database, username=None, password=None, use_managed_identity=False):
+def run_integrity_checks(server, database, username=None, password=None, use_managed_identity=False,
+                         use_token_cache=True):
     """Run all integrity checks on the database."""
     
     print()
@@ -351,12 +550,12 @@ def run_integrity_checks(server, database, username=None, password=None, use_man
     
     print_info(f"Server: {server}")
     print_info(f"Database: {database}")
-    print_info(f"Time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    print_info(f"Time: {time.strftime('%Y-%m-%d %H:%M:%S')}")
     print()
     
     # Connect to database
     print_info("[1/2] Connecting to database...")
-    conn = create_connection(server, database, username, password, use_managed_identity)
+    conn = create_connection(server, database, username, password, use_managed_identity, use_token_cache)
     
     if not conn:
         print_error("\nConnection failed. Exiting.")
@@ -371,75 +570,90 @@ def run_integrity_checks(server, database, username=None, password=None, use_man
     results = {
         "passed": 0,
         "failed": 0,
-        "warnings": 0
+        "warnings": 0,
+        "skipped": 0
     }
     
     try:
         cursor = conn.cursor()
         
-        # Check 1: Database accessibility
-        success, table_count = check_database_accessibility(cursor)
-        if success:
-            results["passed"] += 1
-        else:
-            results["failed"] += 1
+        # pyodbc connections start outside autocommit, so every check runs in
+        # one read-only transaction; dirty reads are fine for metadata counts
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL READ UNCOMMITTED")
         
-        # Check 2: Database size
-        success, used_mb, allocated_mb = check_database_size(cursor)
-        if success:
-            results["passed"] += 1
-        else:
-            results["warnings"] += 1
-        
-        # Check 3: Schema objects
-        success, objects = check_schema_objects(cursor)
-        if success:
-            results["passed"] += 1
-        else:
-            results["warnings"] += 1
+        # Fetch the metadata for every check in one round-trip
+        check_results = fetch_check_results(cursor, server, database)
         
-        # Check 4: Table details
-        success, tables = check_table_details(cursor)
-        if success:
-            results["passed"] += 1
-        else:
-            results["warnings"] += 1
-        
-        # Check 5: Data accessibility
-        success = check_data_accessibility(cursor)
+        # Check 1: Database accessibility
+        success, table_count = check_database_accessibility(check_results["accessibility"])
         if success:
             results["passed"] += 1
         else:
             results["failed"] += 1
+            # Nothing else can be checked on a database that can't be queried
+            results["skipped"] = 7
+            print_warning("      Skipping checks 2-8: database is not accessible")
         
-        # Check 6: Indexes
-        success, index_count = check_indexes(cursor)
-        if success:
-            results["passed"] += 1
-        else:
-            results["warnings"] += 1
-        
-        # Check 7: Constraints
-        success = check_constraints(cursor)
         if success:
-            results["passed"] += 1
-        else:
-            results["warnings"] += 1
-        
-        # Check 8: Database health
-        success = check_database_health(cursor)
-        if success:
-            results["passed"] += 1
-        else:
-            results["warnings"] += 1
+            # Check 2: Database size
+            success, used_mb, allocated_mb = check_database_size(check_results["size"])
+            if success:
+                results["passed"] += 1
+            else:
+                results["warnings"] += 1
+            
+            # Check 3: Schema objects
+            success, objects = check_schema_objects(check_results["object_counts"])
+            if success:
+                results["passed"] += 1
+            else:
+                results["warnings"] += 1
+            
+            # Check 4: Table details
+            success, tables = check_table_details(
+                check_results["table_totals"], check_results["largest_tables"]
+            )
+            if success:
+                results["passed"] += 1
+            else:
+                results["warnings"] += 1
+            
+            # Check 5: Data accessibility
+            success = check_data_accessibility(cursor, check_results["largest_tables"])
+            if success:
+                results["passed"] += 1
+            else:
+                results["failed"] += 1
+            
+            # Check 6: Indexes
+            success, index_count = check_indexes(check_results["object_counts"])
+            if success:
+                results["passed"] += 1
+            else:
+                results["warnings"] += 1
+            
+            # Check 7: Constraints
+            success = check_constraints(check_results["object_counts"])
+            if success:
+                results["passed"] += 1
+            else:
+                results["warnings"] += 1
+            
+            # Check 8: Database health
+            success = check_database_health(check_results["health"])
+            if success:
+                results["passed"] += 1
+            else:
+                results["warnings"] += 1
         
         cursor.close()
+        conn.commit()
         
     except Exception as e:
         print_error(f"\nUnexpected error during integrity checks: {e}")
         results["failed"] += 1
-    finally:
-        conn.close()
+        # Don't leave a connection in an unknown state for later runs
+        discard_connection(conn)
     
     # Print summary
     print()
@@ -453,6 +667,8 @@ def run_integrity_checks(server, database, username=None, password=None, use_man
         print_warning(f"⚠ Warnings: {results['warnings']}/8 checks")
     if results["failed"] > 0:
         print_error(f"✗ Failed: {results['failed']}/8 checks")
+    if results["skipped"] > 0:
+        print_warning(f"- Skipped: {results['skipped']}/8 checks")
     
     print()
     
@@ -509,6 +725,8 @@ Prerequisites:
     parser.add_argument("--username", help="SQL or Azure AD username (optional)")
     parser.add_argument("--password", help="Password (optional)")
     parser.add_argument("--use-managed-identity", action="store_true", help="Use Azure Managed Identity authentication")
+    parser.add_argument("--no-token-cache", action="store_true",
+                        help=f"Do not read or write the Azure AD token cache ({TOKEN_CACHE_FILE})")
     
     args = parser.parse_args()
     
@@ -518,7 +736,8 @@ Prerequisites:
         database=args.database,
         username=args.username,
         password=args.password,
-        use_managed_identity=args.use_managed_identity
+        use_managed_identity=args.use_managed_identity,
+        use_token_cache=not args.no_token_cache
     )
     
     # Exit with appropriate code